@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Measures the overhead of the plugin on synthetic suites.
+
+Every scenario generates a suite of ``items`` tests whose setup goes through a
+chain of ``depth`` fixtures of the given ``scope``, with a function scoped
+fixture at the end failing the first setup of ``failure_rate`` of the items.
+The suite is run in a fresh process with plain pytest (plugin disabled), with
+the plugin loaded and with ``--rerun-setup 1``; the wall-clock time, the
+protocol overhead per item compared to plain pytest and the peak memory of
+every run are reported.
+
+    $ python benchmarks/bench_setup_reruns.py --sizes 1000 10000 --save baseline.json
+    $ python benchmarks/bench_setup_reruns.py --sizes 1000 10000 --compare baseline.json
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = {
+    'plain': ['-p', 'no:failed-to-verify'],
+    'plugin': [],
+    'rerun': ['--rerun-setup', '1'],
+}
+ITEMS_PER_MODULE = 500
+
+CONFTEST = """
+import zlib
+
+import pytest
+
+FAILED = set()
+{fixtures}
+
+@pytest.fixture
+def flaky_leaf(request, fixture_{last}):
+    nodeid = request.node.nodeid
+    if zlib.crc32(nodeid.encode('utf-8')) % 10000 < {threshold} and nodeid not in FAILED:
+        FAILED.add(nodeid)
+        raise Exception('Failure')
+"""
+
+FIXTURE = """
+@pytest.fixture(scope='{scope}')
+def fixture_{index}({argnames}):
+    return {index}
+"""
+
+MODULE = """
+import pytest
+
+
+@pytest.mark.parametrize('index', range({count}))
+def test_example(flaky_leaf, index):
+    assert True
+"""
+
+
+def generate_suite(path, items, scope, depth, failure_rate):
+    """Writes a suite of ``items`` tests to ``path``."""
+    fixtures = ''.join(FIXTURE.format(scope=scope, index=index,
+                                      argnames='fixture_%d' % (index - 1) if index else '')
+                       for index in range(depth))
+    with open(os.path.join(path, 'conftest.py'), 'w') as conftest:
+        conftest.write(CONFTEST.format(fixtures=fixtures, last=depth - 1,
+                                       threshold=int(failure_rate * 10000)))
+    for module, start in enumerate(range(0, items, ITEMS_PER_MODULE)):
+        with open(os.path.join(path, 'test_module_%d.py' % module), 'w') as test_module:
+            test_module.write(MODULE.format(count=min(ITEMS_PER_MODULE, items - start)))
+
+
+class SuiteError(Exception):
+    """A run of a suite ended with neither passing nor failing tests, e.g. on
+    a usage error or an internal error, so its timings mean nothing.
+    """
+
+
+def run_suite(path, mode):
+    """Runs the suite at ``path`` in a fresh process and returns its wall-clock
+    time in seconds and its peak memory in kilobytes.
+    """
+    command = [sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider', path] + MODES[mode]
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=devnull, stderr=devnull, cwd=path)
+        _, status, usage = os.wait4(process.pid, 0)
+        duration = time.time() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if process.returncode not in (0, 1):
+        # 0: all tests passed, 1: some tests failed
+        raise SuiteError('mode=%s exited with status %d: %s' % (mode, process.returncode, ' '.join(command)))
+    return duration, usage.ru_maxrss
+
+
+def run_scenario(items, scope, depth, failure_rate, repeat):
+    path = tempfile.mkdtemp(prefix='bench-setup-reruns-')
+    try:
+        generate_suite(path, items, scope, depth, failure_rate)
+        results = {}
+        for mode in MODES:
+            runs = [run_suite(path, mode) for _ in range(repeat)]
+            results[mode] = {
+                'duration': min(duration for duration, memory in runs),
+                'memory': max(memory for duration, memory in runs),
+            }
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    plain = results['plain']['duration']
+    for mode, result in results.items():
+        result['overhead_per_item'] = (result['duration'] - plain) / items
+        result['ratio'] = result['duration'] / plain if plain else 0.0
+    return results
+
+
+def scenario_key(items, scope, depth, failure_rate, mode):
+    return 'items=%d scope=%s depth=%d failure_rate=%g mode=%s' % (items, scope, depth, failure_rate, mode)
+
+
+def compare(results, baseline, tolerance):
+    """Returns the lines describing the scenarios that got slower or use more
+    memory than ``baseline`` by more than ``tolerance``. Durations are compared
+    relative to plain pytest, so that baselines can be shared between machines.
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        expected = baseline.get(key)
+        if expected is None or key.endswith('mode=plain'):
+            continue
+        if result['ratio'] > expected['ratio'] * (1 + tolerance):
+            regressions.append('%s: %.2fx plain pytest, baseline %.2fx' % (key, result['ratio'], expected['ratio']))
+        if result['memory'] > expected['memory'] * (1 + tolerance):
+            regressions.append('%s: %d KB peak memory, baseline %d KB' % (key, result['memory'], expected['memory']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--scopes', nargs='+', default=['function', 'module', 'session'])
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--failure-rates', type=float, nargs='+', default=[0.0, 0.01, 0.1])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs of every scenario, the fastest one counts.")
+    parser.add_argument('--save', help="write the results to this baseline file.")
+    parser.add_argument('--compare', help="fail when the results regress from this baseline file.")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed relative regression, defaults to 0.2.")
+    options = parser.parse_args(argv)
+
+    results = {}
+    errors = []
+    for items, scope, depth, failure_rate in itertools.product(
+            options.sizes, options.scopes, options.depths, options.failure_rates):
+        try:
+            scenario = run_scenario(items, scope, depth, failure_rate, options.repeat)
+        except SuiteError as error:
+            errors.append('items=%d scope=%s depth=%d failure_rate=%g %s' % (items, scope, depth, failure_rate, error))
+            print('ERROR %s' % errors[-1])
+            sys.stdout.flush()
+            continue
+        for mode in MODES:
+            result = scenario[mode]
+            results[scenario_key(items, scope, depth, failure_rate, mode)] = result
+            print('%-70s %8.2fs %8.1fus/item %8d KB' % (scenario_key(items, scope, depth, failure_rate, mode),
+                                                        result['duration'], result['overhead_per_item'] * 1e6,
+                                                        result['memory']))
+            sys.stdout.flush()
+
+    if options.save:
+        with open(options.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), options.tolerance)
+        for line in regressions:
+            print('REGRESSION %s' % line)
+        return 1 if regressions or errors else 0
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
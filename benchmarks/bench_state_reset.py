@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Measures finding and resetting the failed fixtures of an item between two
+setup attempts: scanning all fixtures of the item, as needed when the setup
+failed on an error cached by an earlier item, against resetting the fixtures
+tracked while the setup ran.
+
+    $ python benchmarks/bench_state_reset.py --fixtures 10 100 1000
+"""
+import argparse
+import sys
+import timeit
+
+from pytest_failed_to_verify import _get_failed_fixturedefs, _remove_cached_results_from_failed_fixtures
+
+
+class FixtureDef(object):
+    def __init__(self, argname, argnames):
+        self.argname = argname
+        self.argnames = argnames
+        self.baseid = ''
+        self.cached_result = (argname, 0, None)
+
+
+class FixtureInfo(object):
+    def __init__(self, name2fixturedefs):
+        self.name2fixturedefs = name2fixturedefs
+
+
+class Item(object):
+    def __init__(self, fixtures):
+        fixturedefs = [FixtureDef('fixture_%d' % index, ('fixture_%d' % (index - 1),) if index else ())
+                       for index in range(fixtures)]
+        self._fixtureinfo = FixtureInfo(dict((fixturedef.argname, [fixturedef]) for fixturedef in fixturedefs))
+        self.failed = fixturedefs[-1]
+
+    def fail(self):
+        self.failed.cached_result = (None, 0, (Exception, Exception('Failure'), None))
+
+
+def scan(item):
+    item.fail()
+    _remove_cached_results_from_failed_fixtures(_get_failed_fixturedefs(item))
+
+
+def tracked(item):
+    item.fail()
+    _remove_cached_results_from_failed_fixtures([item.failed])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--fixtures', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--number', type=int, default=2000)
+    options = parser.parse_args(argv)
+
+    for fixtures in options.fixtures:
+        item = Item(fixtures)
+        results = [(name, min(timeit.repeat(lambda: function(item), number=options.number, repeat=5)) / options.number)
+                   for name, function in (('scan', scan), ('tracked', tracked))]
+        print('fixtures=%-6d %s' % (fixtures, '  '.join('%s %8.2fus' % (name, seconds * 1e6) for name, seconds in results)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,37 @@
-import pkg_resources
+import contextlib
+import fnmatch
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import random
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+
 import pytest
-from _pytest.resultlog import ResultLog
-from _pytest.runner import runtestprotocol
+from _pytest import hookspec
+from _pytest.outcomes import TEST_OUTCOME
+from _pytest.reports import TestReport
+from _pytest.runner import CallInfo, call_and_report, show_test_item
+
+BACKOFF_POLICIES = ('fixed', 'exponential', 'jitter')
+SUMMARY_SAMPLES = 3
+# attributes the plugin adds to test reports, with their defaults
+REPORT_FIELDS = {
+    'rerun': 0,
+    'failed_to_verify': False,
+    'failed_fixtures': [],
+    'history_fixtures': [],
+    'teardown_reruns': 0,
+}
 
 
 @pytest.hookimpl(tryfirst=True, hookwrapper=True)
@@ -15,6 +45,31 @@ def pytest_runtest_makereport(item, call):
         rep.outcome = 'failed'
 
 
+def _get_distribution_version(name):
+    """Returns the installed version of distribution ``name`` as a tuple of
+    its leading numbers, or None when it is not installed.
+    """
+    try:
+        from importlib import metadata
+    except ImportError:  # python < 3.8
+        try:
+            import importlib_metadata as metadata
+        except ImportError:  # the backport comes with pytest>=4.6
+            metadata = None
+    if metadata is None:
+        import pkg_resources
+        try:
+            version = pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            return None
+    else:
+        try:
+            version = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            return None
+    return tuple(int(part) for part in re.findall(r'\d+', version.split('+')[0])[:3])
+
+
 def works_with_current_xdist():
     """Returns compatibility with installed pytest-xdist version.
     When running tests in parallel using pytest-xdist < 1.20.0, the first
@@ -22,11 +77,10 @@ def works_with_current_xdist():
     rerunning the test. Thus we must skip logging of intermediate results under
     these circumstances, otherwise no test is rerun.
     """
-    try:
-        d = pkg_resources.get_distribution('pytest-xdist')
-        return d.parsed_version >= pkg_resources.parse_version('1.20')
-    except pkg_resources.DistributionNotFound:
+    version = _get_distribution_version('pytest-xdist')
+    if version is None:
         return None
+    return version >= (1, 20)
 
 
 # command line options
@@ -41,14 +95,442 @@ def pytest_addoption(parser):
         type=int,
         default=0,
         help="number of times to re-run failed setup phase. defaults to 0.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-delay',
+        action="store",
+        dest="rerun_setup_delay",
+        type=float,
+        default=None,
+        help="base delay in seconds before re-running a failed setup phase. "
+             "defaults to 0.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-backoff',
+        action="store",
+        dest="rerun_setup_backoff",
+        choices=BACKOFF_POLICIES,
+        default=None,
+        help="how the delay grows between setup re-runs: 'fixed', "
+             "'exponential' or 'jitter' (decorrelated jitter). "
+             "defaults to 'fixed'.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-max-delay',
+        action="store",
+        dest="rerun_setup_max_delay",
+        type=float,
+        default=None,
+        help="upper bound in seconds for a single setup re-run delay.")
+    rerun_setup_group._addoption(
+        '--rerun-teardown',
+        action="store",
+        dest="rerun_teardown",
+        type=int,
+        default=None,
+        help="number of times to re-invoke a failing fixture finalizer "
+             "before its teardown errors. defaults to 0.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-budget',
+        action="store",
+        dest="rerun_setup_budget",
+        type=int,
+        default=None,
+        help="maximum number of setup re-runs for the whole session. "
+             "defaults to no limit.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-timeout',
+        action="store",
+        dest="rerun_setup_timeout",
+        type=float,
+        default=None,
+        help="seconds after which a hanging setup is interrupted and fails, "
+             "to be re-run like any other failed setup. defaults to no limit.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-reuse-size',
+        action="store",
+        dest="rerun_setup_reuse_size",
+        type=int,
+        default=None,
+        help="number of results of reusable fixtures kept for the other "
+             "parametrizations of a test. defaults to 128.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-spare-threads',
+        action="store",
+        dest="rerun_setup_spare_threads",
+        type=int,
+        default=None,
+        help="number of spare fixture instances set up in the background "
+             "at a time. defaults to 2.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-deferred',
+        action="store_true",
+        dest="rerun_setup_deferred",
+        default=None,
+        help="re-run failed setups after the rest of the session instead of "
+             "right away, grouped by the failing fixture.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-circuit-breaker',
+        action="store",
+        dest="rerun_setup_circuit_breaker",
+        type=int,
+        default=None,
+        help="number of consecutive setup failures of a fixture after which "
+             "the items using it fail to verify without running. "
+             "defaults to 0 (disabled).")
+    rerun_setup_group._addoption(
+        '--rerun-setup-circuit-cooldown',
+        action="store",
+        dest="rerun_setup_circuit_cooldown",
+        type=float,
+        default=None,
+        help="seconds after which an open circuit lets a single item probe "
+             "whether the fixture recovered. defaults to 30.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-signals',
+        action="store",
+        dest="rerun_setup_signals",
+        default=None,
+        help="file through which processes share circuit breaker signals. "
+             "created automatically for pytest-xdist workers.")
+    rerun_setup_group._addoption(
+        '--max-failed-to-verify',
+        action="store",
+        dest="max_failed_to_verify",
+        default=None,
+        help="stop the session once this number, or with a trailing '%%' this "
+             "share of the collected items, failed to verify. 0 disables it.")
+    rerun_setup_group._addoption(
+        '--max-failed-to-verify-rate',
+        action="store",
+        dest="max_failed_to_verify_rate",
+        type=float,
+        default=None,
+        help="stop the session once the share of items failing to verify "
+             "among the last --failed-to-verify-window items reaches this "
+             "rate (0-1). 0 disables it.")
+    rerun_setup_group._addoption(
+        '--failed-to-verify-window',
+        action="store",
+        dest="failed_to_verify_window",
+        type=int,
+        default=None,
+        help="number of items --max-failed-to-verify-rate looks at. "
+             "defaults to 50.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-adaptive',
+        action="store_true",
+        dest="rerun_setup_adaptive",
+        default=None,
+        help="pick the number of setup re-runs of every test from its "
+             "recorded history instead of the global setting.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-flaky-first',
+        action="store_true",
+        dest="rerun_setup_flaky_first",
+        default=None,
+        help="run the tests whose setup failed most and cost most in the "
+             "recorded history first.")
+    rerun_setup_group._addoption(
+        '--ftv-last',
+        action="store_true",
+        dest="ftv_last",
+        default=False,
+        help="run only the tests that failed to verify in their last run, "
+             "or all of them when none did.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-forked',
+        action="store_true",
+        dest="rerun_setup_forked",
+        default=None,
+        help="run every setup re-run in a forked process, so that state left "
+             "behind by the failed attempts cannot affect it.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-costs',
+        action="store",
+        dest="rerun_setup_costs",
+        type=int,
+        default=None,
+        help="show the N most costly fixtures and items of the setup phase "
+             "and the time spent on setup re-runs. defaults to 0 (disabled).")
+    rerun_setup_group._addoption(
+        '--rerun-setup-costs-json',
+        action="store",
+        dest="rerun_setup_costs_json",
+        default=None,
+        help="write the setup costs of every fixture and item to a JSON file.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-compact-reports',
+        action="store_true",
+        dest="rerun_setup_compact_reports",
+        default=None,
+        help="keep only a one line summary of the failures of re-run setups, "
+             "shared by identical tracebacks. the final report stays complete.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-failures-json',
+        action="store",
+        dest="rerun_setup_failures_json",
+        default=None,
+        help="write every item that failed to verify, grouped by traceback "
+             "and failing fixture, to a JSON file.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-metrics',
+        action="store",
+        dest="rerun_setup_metrics",
+        default=None,
+        help="keep setup attempt metrics in a Prometheus text file, "
+             "rewritten while the session runs.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-metrics-interval',
+        action="store",
+        dest="rerun_setup_metrics_interval",
+        type=float,
+        default=None,
+        help="seconds between two rewrites of the metrics file. defaults to 10.")
+    rerun_setup_group._addoption(
+        '--rerun-setup-log',
+        action="store",
+        dest="rerun_setup_log",
+        default=None,
+        help="stream every test report, including setup re-runs, as JSON "
+             "lines to a file.")
+    parser.addini(
+        'rerun_setup_delay',
+        help="base delay in seconds before re-running a failed setup phase.",
+        default='0')
+    parser.addini(
+        'rerun_setup_backoff',
+        help="delay policy between setup re-runs (fixed, exponential, jitter).",
+        default='fixed')
+    parser.addini(
+        'rerun_setup_max_delay',
+        help="upper bound in seconds for a single setup re-run delay.",
+        default='')
+    parser.addini(
+        'rerun_teardown',
+        help="number of times to re-invoke a failing fixture finalizer.",
+        default='0')
+    parser.addini(
+        'rerun_setup_budget',
+        help="maximum number of setup re-runs for the whole session.",
+        default='')
+    parser.addini(
+        'rerun_setup_timeout',
+        help="seconds after which a hanging setup is interrupted and fails.",
+        default='')
+    parser.addini(
+        'rerun_setup_reuse_size',
+        help="number of results of reusable fixtures kept for the other parametrizations of a test.",
+        default='128')
+    parser.addini(
+        'rerun_setup_spare_threads',
+        help="number of spare fixture instances set up in the background at a time.",
+        default='2')
+    parser.addini(
+        'rerun_setup_deferred',
+        type='bool',
+        help="re-run failed setups after the rest of the session.",
+        default=False)
+    parser.addini(
+        'rerun_setup_circuit_breaker',
+        help="consecutive setup failures of a fixture that open its circuit.",
+        default='0')
+    parser.addini(
+        'rerun_setup_circuit_cooldown',
+        help="seconds before an open circuit lets an item probe the fixture.",
+        default='30')
+    parser.addini(
+        'rerun_setup_nodeids',
+        type='linelist',
+        help="'<nodeid glob> <reruns>' lines setting the number of setup "
+             "re-runs for matching tests, first match wins.")
+    parser.addini(
+        'max_failed_to_verify',
+        help="number or percentage of items failing to verify that stops the session.",
+        default='')
+    parser.addini(
+        'max_failed_to_verify_rate',
+        help="share of the last items failing to verify that stops the session.",
+        default='')
+    parser.addini(
+        'failed_to_verify_window',
+        help="number of items the failed to verify rate looks at.",
+        default='50')
+    parser.addini(
+        'rerun_setup_adaptive',
+        type='bool',
+        help="pick the number of setup re-runs from the recorded history.",
+        default=False)
+    parser.addini(
+        'rerun_setup_history_window',
+        help="number of runs kept in the setup history of every test and fixture.",
+        default='10')
+    parser.addini(
+        'rerun_setup_compact_reports',
+        type='bool',
+        help="keep only a one line summary of the failures of re-run setups.",
+        default=False)
+    parser.addini(
+        'rerun_setup_flaky_first',
+        type='bool',
+        help="run the tests with the flakiest recorded setups first.",
+        default=False)
+    parser.addini(
+        'rerun_setup_forked',
+        type='bool',
+        help="run every setup re-run in a forked process.",
+        default=False)
+    parser.addini(
+        'rerun_setup_metrics_interval',
+        help="seconds between two rewrites of the setup metrics file.",
+        default='10')
+    parser.addini(
+        'rerun_setup_costs',
+        help="number of most costly fixtures and items shown in the setup cost summary.",
+        default='0')
+
+
+def _get_workerinput(config):
+    """Returns the pytest-xdist worker input, None outside of workers."""
+    return getattr(config, 'workerinput', getattr(config, 'slaveinput', None))
+
+
+def _get_option(config, name):
+    """Returns the command line value of ``name``, falling back to the ini
+    value of the same name when the option was not given.
+    """
+    value = config.getoption(name)
+    if value is None:
+        value = config.getini(name)
+        if value == '':
+            value = None
+    return value
 
 
 def pytest_configure(config):
     # add flaky marker
     config.addinivalue_line(
-        "markers", "flaky(reruns=1, reruns_delay=0): mark test to re-run up "
-                   "to 'reruns' times. Add a delay of 'reruns_delay' seconds "
-                   "between re-runs.")
+        "markers", "flaky(reruns=1, reruns_delay=0, backoff='fixed', "
+                   "setup_timeout=None): mark test to re-run up to 'reruns' "
+                   "times. Add a delay of 'reruns_delay' seconds between "
+                   "re-runs, growing according to 'backoff'. Interrupt setups "
+                   "taking longer than 'setup_timeout' seconds.")
+
+    config._setup_memo = SetupMemo(int(_get_option(config, 'rerun_setup_reuse_size')))
+    config.pluginmanager.register(config._setup_memo, 'rerun-setup-memo')
+
+    config._rerun_setup_forked = bool(_get_option(config, 'rerun_setup_forked'))
+    if config._rerun_setup_forked and not hasattr(os, 'fork'):
+        raise pytest.UsageError("--rerun-setup-forked needs a platform supporting os.fork")
+    if config._rerun_setup_forked and not hasattr(hookspec, 'pytest_report_to_serializable'):
+        # the reports of a forked re-run are serialized to reach the parent
+        raise pytest.UsageError("--rerun-setup-forked needs pytest>=4.4")
+    if not config._rerun_setup_forked:
+        # spares set up by threads of this process cannot move into a forked re-run
+        spare_pool = SparePool(int(_get_option(config, 'rerun_setup_spare_threads')))
+        config.pluginmanager.register(spare_pool, 'rerun-setup-spares')
+
+    config._works_with_current_xdist = None
+    if _get_workerinput(config) is not None:
+        # resolved once, the intermediate reports of every re-run depend on it
+        config._works_with_current_xdist = works_with_current_xdist()
+
+    config._rerun_teardown = int(_get_option(config, 'rerun_teardown'))
+
+    budget = _get_option(config, 'rerun_setup_budget')
+    config._rerun_setup_budget = None if budget is None else int(budget)
+
+    threshold = int(_get_option(config, 'rerun_setup_circuit_breaker'))
+    config._setup_circuit_breaker = None
+    if threshold > 0:
+        cooldown = float(_get_option(config, 'rerun_setup_circuit_cooldown'))
+        config._setup_circuit_breaker = SetupCircuitBreaker(threshold, cooldown)
+
+        workerinput = _get_workerinput(config) or {}
+        path = workerinput.get('rerun_setup_signals') or config.getoption('rerun_setup_signals')
+        if path:
+            config._setup_circuit_breaker.signals = SetupSignals(path, workerinput.get('workerid'))
+
+    limit = _get_option(config, 'max_failed_to_verify')
+    rate = _get_option(config, 'max_failed_to_verify_rate')
+    if (limit is not None or rate is not None) and _get_workerinput(config) is None:
+        window = int(_get_option(config, 'failed_to_verify_window'))
+        config.pluginmanager.register(
+            FailedToVerifyLimit(config, limit, None if rate is None else float(rate), window),
+            'failed-to-verify-limit')
+
+    config._setup_history = None
+    if getattr(config, 'cache', None) is not None:
+        window = int(config.getini('rerun_setup_history_window'))
+        config._setup_history = SetupHistory(config, window)
+        config.pluginmanager.register(config._setup_history, 'rerun-setup-history')
+        config.pluginmanager.register(LastFailedToVerify(config), 'rerun-setup-last-failed-to-verify')
+
+    top = int(_get_option(config, 'rerun_setup_costs'))
+    json_path = config.getoption('rerun_setup_costs_json')
+    config._setup_costs = None
+    if top > 0 or json_path:
+        config._setup_costs = SetupCosts(config, top, json_path)
+        config.pluginmanager.register(config._setup_costs, 'rerun-setup-costs')
+
+    if _get_option(config, 'rerun_setup_compact_reports'):
+        config.pluginmanager.register(CompactRerunReports(), 'rerun-setup-compact-reports')
+
+    metrics_path = config.getoption('rerun_setup_metrics')
+    if metrics_path and _get_workerinput(config) is None:
+        interval = float(_get_option(config, 'rerun_setup_metrics_interval'))
+        config.pluginmanager.register(SetupMetrics(metrics_path, interval), 'rerun-setup-metrics')
+
+    log_path = config.getoption('rerun_setup_log')
+    config._setup_event_log = None
+    if log_path and _get_workerinput(config) is None:
+        config._setup_event_log = SetupEventLog(log_path)
+        config.pluginmanager.register(config._setup_event_log, 'rerun-setup-log')
+
+
+@pytest.hookimpl(hookwrapper=True, optionalhook=True)
+def pytest_report_to_serializable(config, report):
+    """Makes sure the attributes the plugin adds to test reports are part of
+    their serialized form, e.g. when pytest-xdist sends them to the controller.
+    """
+    outcome = yield
+    data = outcome.get_result()
+    if data is not None and getattr(report, 'when', None) is not None:
+        for name in REPORT_FIELDS:
+            if hasattr(report, name):
+                value = getattr(report, name)
+                data[name] = list(value) if isinstance(value, tuple) else value
+
+
+@pytest.hookimpl(hookwrapper=True, optionalhook=True)
+def pytest_report_from_serializable(config, data):
+    """Gives deserialized test reports the attributes the plugin adds, also
+    when the sender did not set them.
+    """
+    outcome = yield
+    report = outcome.get_result()
+    if report is not None and getattr(report, 'when', None) is not None:
+        for name, default in REPORT_FIELDS.items():
+            if not hasattr(report, name):
+                setattr(report, name, list(default) if isinstance(default, list) else default)
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_configure_node(node):
+    """Hands the signals file shared by all workers to a pytest-xdist worker."""
+    config = node.config
+    if int(_get_option(config, 'rerun_setup_circuit_breaker')) <= 0:
+        return
+    if not getattr(config, '_setup_signals_path', None):
+        path = config.getoption('rerun_setup_signals')
+        if not path:
+            config._setup_signals_dir = tempfile.mkdtemp(prefix='pytest-failed-to-verify-')
+            path = os.path.join(config._setup_signals_dir, 'setup-signals.jsonl')
+        config._setup_signals_path = path
+    node.workerinput['rerun_setup_signals'] = config._setup_signals_path
+
+
+def pytest_unconfigure(config):
+    signals_dir = getattr(config, '_setup_signals_dir', None)
+    if signals_dir:
+        shutil.rmtree(signals_dir, ignore_errors=True)
 
 
 # making sure the options make sense
@@ -61,14 +543,139 @@ def check_options(config):
                 raise pytest.UsageError("--reruns incompatible with --pdb")
 
     resultlog = getattr(config, '_resultlog', None)
-    if resultlog:
+    if resultlog and not getattr(resultlog, 'rerun_setup', False):
         logfile = resultlog.logfile
         config.pluginmanager.unregister(resultlog)
-        config._resultlog = RerunResultLog(config, logfile)
+        config._resultlog = _make_rerun_result_log(config, logfile)
         config.pluginmanager.register(config._resultlog)
 
 
-def get_rerun_setup_count(item):
+def _is_async_fixture(func):
+    is_coroutine = getattr(inspect, 'iscoroutinefunction', lambda func: False)
+    is_async_generator = getattr(inspect, 'isasyncgenfunction', lambda func: False)
+    return is_coroutine(func) or is_async_generator(func)
+
+
+def flaky_setup(reruns=None, retries=None, timeout=None, reusable=False, teardown_reruns=None, spares=0):
+    """Annotates a fixture function with its own number of setup re-runs.
+    When the fixture fails during setup, the item is re-run up to ``reruns``
+    times regardless of the marker or command line setting. Can be applied
+    above or below ``@pytest.fixture``.
+
+    A setup of the fixture taking longer than ``timeout`` seconds is
+    interrupted and fails like any other setup failure.
+
+    The result of a ``reusable`` function scoped fixture is set up once and
+    shared by all parametrizations of a test that pass it the same parameters,
+    whether it came from a re-run or not. Only fixtures returning their value
+    without a teardown can be reusable.
+
+    Coroutine fixtures (e.g. of pytest-asyncio) can also be retried up to
+    ``retries`` times inside the event loop they run in, every attempt limited
+    to ``timeout`` seconds, before their setup fails. The other fixtures of the
+    item, like the event loop itself, are kept. This needs Python 3.6 and the
+    decorator to be applied below the fixture decorator.
+
+    Finalizers the fixture adds with ``request.addfinalizer`` are re-invoked
+    up to ``teardown_reruns`` times while they fail, regardless of the command
+    line setting.
+
+    While the fixture is set up, up to ``spares`` more instances of it are set
+    up in background threads. A re-run of its setup takes a ready spare
+    instead of setting it up again, as long as the fixtures it depends on did
+    not change. Spares left over are torn down when the scope of the fixture
+    ends. Fixtures with spares cannot take the ``request`` fixture.
+    """
+    def decorator(func):
+        settings = {'reruns': reruns, 'timeout': timeout, 'reusable': reusable,
+                    'teardown_reruns': teardown_reruns, 'spares': spares}
+        function = _get_fixture_function(func)
+        if reusable and (inspect.isgeneratorfunction(function) or _is_async_fixture(function)):
+            raise TypeError("reusable fixtures of flaky_setup have to return their value "
+                            "without a teardown, got %r" % (func,))
+        if spares and (_is_async_fixture(function) or 'request' in _get_argnames(function)):
+            raise TypeError("spares of flaky_setup need a fixture set up without the event loop "
+                            "or the request fixture, got %r" % (func,))
+        if _is_async_fixture(func) and (retries is not None or timeout is not None):
+            if sys.version_info < (3, 6):
+                raise TypeError("retries and timeout of flaky_setup need Python 3.6")
+            from pytest_failed_to_verify_async import retry_coroutine_fixture
+            func = retry_coroutine_fixture(func, retries, timeout)
+            # every attempt in the event loop has its own timeout
+            settings['timeout'] = None
+        elif retries is not None:
+            raise TypeError("retries of flaky_setup need a coroutine fixture below "
+                            "the fixture decorator, got %r" % (func,))
+        func._flaky_setup = settings
+        _get_fixture_function(func)._flaky_setup = settings
+        return func
+    return decorator
+
+
+def _get_fixture_function(func):
+    """Returns the function of a fixture, also when ``func`` is what
+    ``@pytest.fixture`` returned for it.
+    """
+    wrapped = getattr(func, '__pytest_wrapped__', None)
+    if wrapped is not None:  # pytest < 8.4
+        return wrapped.obj
+    return getattr(func, '_fixture_function', func)
+
+
+def _get_argnames(func):
+    func = getattr(func, '__wrapped__', func)
+    code = getattr(func, '__code__', None)
+    return code.co_varnames[:code.co_argcount] if code is not None else ()
+
+
+def _get_fixture_setting(fixturedef, name):
+    settings = getattr(fixturedef.func, '_flaky_setup', None) or {}
+    return settings.get(name)
+
+
+def _get_nodeid_rerun_count(item):
+    for line in item.session.config.getini('rerun_setup_nodeids'):
+        try:
+            pattern, count = line.rsplit(None, 1)
+            count = int(count)
+        except ValueError:
+            raise pytest.UsageError("invalid rerun_setup_nodeids line %r, "
+                                    "expected '<nodeid glob> <reruns>'" % (line,))
+        if fnmatch.fnmatch(item.nodeid, pattern):
+            return count
+    return None
+
+
+def get_rerun_setup_count(item, failed_fixturedefs=()):
+    """Returns the number of setup re-runs for ``item``. The most specific
+    setting wins: a ``flaky_setup`` annotation on one of the fixtures that
+    failed, the ``flaky`` marker, the ``rerun_setup_nodeids`` ini globs, the
+    recorded history with ``--rerun-setup-adaptive`` and finally the global
+    ``--rerun-setup`` option.
+    """
+    fixture_reruns = [_get_fixture_setting(fixturedef, 'reruns')
+                      for fixturedef in failed_fixturedefs]
+    fixture_reruns = [reruns for reruns in fixture_reruns if reruns is not None]
+    if fixture_reruns:
+        return max(fixture_reruns)
+
+    marker = item.get_closest_marker('flaky')
+    if marker is not None:
+        reruns = marker.kwargs.get('reruns', marker.args[0] if marker.args else None)
+        if reruns is not None:
+            return reruns
+
+    reruns = _get_nodeid_rerun_count(item)
+    if reruns is not None:
+        return reruns
+
+    history = getattr(item.config, '_setup_history', None)
+    if history is not None and _get_option(item.config, 'rerun_setup_adaptive'):
+        fixture_keys = [_fixture_key(fixturedef) for fixturedef in failed_fixturedefs]
+        reruns = history.get_rerun_count(item.nodeid, fixture_keys)
+        if reruns is not None:
+            return reruns
+
     rerun_setup = 0
     if item.session.config.option.rerun_setup:
         # default to the global setting
@@ -77,41 +684,573 @@ def get_rerun_setup_count(item):
     return rerun_setup
 
 
-def _remove_cached_results_from_failed_fixtures(item):
+def get_rerun_setup_delay(item):
+    """Returns the number of seconds to wait before the next setup re-run of
+    ``item``. ``fixed`` waits the base delay every time, ``exponential``
+    doubles it on every re-run and ``jitter`` picks a random delay between the
+    base delay and three times the previous one (decorrelated jitter).
+    """
+    config = item.session.config
+    marker = item.get_closest_marker('flaky')
+    delay = marker.kwargs.get('reruns_delay') if marker else None
+    if delay is None:
+        delay = _get_option(config, 'rerun_setup_delay')
+    backoff = marker.kwargs.get('backoff') if marker else None
+    if backoff is None:
+        backoff = _get_option(config, 'rerun_setup_backoff')
+    delay = _get_backoff_delay(config, delay, backoff, item.execution_count,
+                               getattr(item, '_rerun_setup_delay', None))
+    item._rerun_setup_delay = delay
+    return delay
+
+
+def _get_backoff_delay(config, delay, backoff, attempt, previous=None):
+    """Returns the delay before re-run number ``attempt`` for the base
+    ``delay`` growing according to ``backoff``, ``previous`` being the delay
+    before the re-run before.
+    """
+    if backoff not in BACKOFF_POLICIES:
+        raise pytest.UsageError("unknown setup re-run backoff %r, expected one of %s"
+                                % (backoff, ', '.join(BACKOFF_POLICIES)))
+    max_delay = _get_option(config, 'rerun_setup_max_delay')
+
+    delay = float(delay or 0)
+    if backoff == 'exponential':
+        delay *= 2 ** (attempt - 1)
+    elif backoff == 'jitter':
+        previous = delay if previous is None else previous
+        delay = random.uniform(delay, max(delay, previous * 3))
+    if max_delay is not None:
+        delay = min(delay, float(max_delay))
+    return delay
+
+
+def get_rerun_teardown_count(config, fixturedef):
+    """Returns the number of times a failing finalizer of ``fixturedef`` is
+    re-invoked: its ``flaky_setup`` annotation or the ``--rerun-teardown``
+    option.
+    """
+    reruns = _get_fixture_setting(fixturedef, 'teardown_reruns')
+    if reruns is None:
+        reruns = getattr(config, '_rerun_teardown', 0)
+    return reruns
+
+
+def _retry_finalizer(config, finalizer, reruns):
+    """Returns ``finalizer`` re-invoked up to ``reruns`` times while it
+    fails, waiting the setup re-run delay in between. The re-runs are counted
+    for the teardown report of the item being torn down.
+    """
+    def retrying_finalizer():
+        delay = None
+        for attempt in range(reruns + 1):
+            try:
+                return finalizer()
+            except Exception:
+                if attempt == reruns:
+                    raise
+                config._teardown_reruns = getattr(config, '_teardown_reruns', 0) + 1
+                delay = _get_backoff_delay(config, _get_option(config, 'rerun_setup_delay'),
+                                           _get_option(config, 'rerun_setup_backoff'), attempt + 1, delay)
+                _wait_before_rerun(delay)
+    return retrying_finalizer
+
+
+def _retry_teardown_finalizers(config, fixturedef, start):
+    """Makes the finalizers ``fixturedef`` added from index ``start`` on
+    re-invoke themselves while they fail.
+    """
+    reruns = get_rerun_teardown_count(config, fixturedef)
+    finalizers = getattr(fixturedef, '_finalizers', None)
+    if not reruns or finalizers is None:
+        return
+    is_async_generator = getattr(inspect, 'isasyncgen', lambda obj: False)
+    for index in range(start, len(finalizers)):
+        finalizer = finalizers[index]
+        # the teardown of a yield fixture resumes its generator, which cannot
+        # run again once it raised
+        if any(inspect.isgenerator(arg) or is_async_generator(arg) for arg in getattr(finalizer, 'args', ())):
+            continue
+        finalizers[index] = _retry_finalizer(config, finalizer, reruns)
+
+
+def get_rerun_setup_timeout(item):
+    """Returns the number of seconds after which the setup of ``item`` is
+    interrupted, from the ``flaky`` marker or the ``--rerun-setup-timeout``
+    option, or None when it may take as long as it needs.
+    """
+    marker = item.get_closest_marker('flaky')
+    timeout = marker.kwargs.get('setup_timeout') if marker else None
+    if timeout is None:
+        timeout = _get_option(item.config, 'rerun_setup_timeout')
+    return None if timeout is None else float(timeout)
+
+
+class SetupTimeout(Exception):
+    """Raised into a setup that took longer than its timeout."""
+
+
+@contextlib.contextmanager
+def _setup_timeout(seconds, description):
+    """Raises ``SetupTimeout`` into the code running in the block once it took
+    longer than ``seconds``. Relies on SIGALRM, so only limits the main thread
+    on platforms having it. An outer timeout expiring earlier is kept.
     """
-    Note: remove all cached_result attribute from every fixture
+    if (not seconds or not hasattr(signal, 'setitimer') or
+            threading.current_thread().name != 'MainThread'):
+        yield
+        return
+
+    def interrupt(signum, frame):
+        raise SetupTimeout("%s exceeded the setup timeout of %s seconds" % (description, seconds))
+
+    previous_delay = signal.getitimer(signal.ITIMER_REAL)[0]
+    if previous_delay and previous_delay <= seconds:
+        yield
+        return
+    start = time.time()
+    previous_handler = signal.signal(signal.SIGALRM, interrupt)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        if previous_delay:
+            signal.setitimer(signal.ITIMER_REAL, max(previous_delay - (time.time() - start), 1e-6))
+
+
+def _rerun_budget_available(config):
+    budget = getattr(config, '_rerun_setup_budget', None)
+    return budget is None or budget > 0
+
+
+def _consume_rerun_budget(config):
+    if getattr(config, '_rerun_setup_budget', None) is not None:
+        config._rerun_setup_budget -= 1
+
+
+def _fixture_key(fixturedef):
+    """Returns a name identifying ``fixturedef`` across items."""
+    if fixturedef.baseid:
+        return "%s::%s" % (fixturedef.baseid, fixturedef.argname)
+    return fixturedef.argname
+
+
+def _get_fixture_keys(item):
+    """Returns the keys of the fixtures ``item`` uses."""
+    name2fixturedefs = getattr(getattr(item, '_fixtureinfo', None), 'name2fixturedefs', {})
+    return [_fixture_key(fixture_defs[-1]) for fixture_defs in name2fixturedefs.values() if fixture_defs]
+
+
+def _get_failed_fixturedefs(item):
+    """Returns the fixtures of ``item`` holding a setup error, found by looking
+    at all of them. Only needed when the setup failed on an error cached by an
+    earlier item, the failures of the attempt itself are tracked while the
+    fixtures are set up.
     """
-    cached_result = 'cached_result'
+    failed = []
     fixture_info = getattr(item, '_fixtureinfo', None)
-    for fixture_def_str in getattr(fixture_info, 'name2fixturedefs', ()):
-        fixture_defs = fixture_info.name2fixturedefs[fixture_def_str]
+    for fixture_defs in getattr(fixture_info, 'name2fixturedefs', {}).values():
         for fixture_def in fixture_defs:
-            if hasattr(fixture_def, cached_result):
-                result, cache_key, err = getattr(fixture_def, cached_result)
-                if err:  # Deleting cached results for only failed fixtures
-                    delattr(fixture_def, cached_result)
+            cached_result = getattr(fixture_def, 'cached_result', None)
+            if cached_result is not None and cached_result[2]:
+                failed.append(fixture_def)
+    return failed
+
+
+def _remove_cached_results_from_failed_fixtures(failed_fixturedefs):
+    """
+    Note: remove the cached_result attribute from the fixtures that failed,
+    fixtures that were set up successfully keep their value. Fixtures
+    depending on a failed one never got a result of their own. The
+    finalizers a failed fixture added before failing are called, pytest>=8
+    refuses to set up a fixture that still has finalizers. A fixture whose
+    setup hook failed before caching anything has no cached_result but may
+    still have finalizers.
+    """
+    for fixture_def in failed_fixturedefs:
+        cached_result = getattr(fixture_def, 'cached_result', None)
+        if cached_result is None or cached_result[2]:
+            finalizers = getattr(fixture_def, '_finalizers', None) or []
+            while finalizers:
+                try:
+                    finalizers.pop()()
+                except TEST_OUTCOME:
+                    # teardown of a failed setup attempt is never reported
+                    pass
+            # Deleting cached results for only failed fixtures
+            fixture_def.cached_result = None
 
 
 def _remove_failed_setup_state_from_session(item):
     """
-    Note: remove all _prepare_exc attribute from every col in stack of _setupstate and cleaning the stack itself
+    Note: tear down the collectors of _setupstate from the first one that
+    failed up to the item itself and remove their _prepare_exc attribute,
+    collectors set up successfully above them stay on the stack
     """
     prepare_exc = "_prepare_exc"
     setup_state = getattr(item.session, '_setupstate')
-    for col in setup_state.stack:
+    stack = setup_state.stack
+    if isinstance(stack, dict):
+        _remove_failed_setup_state_from_stack(item, stack)
+        return
+    failed = [index for index, col in enumerate(stack)
+              if hasattr(col, prepare_exc) or col is item]
+    if not failed:
+        return
+    while len(stack) > failed[0]:
+        col = stack.pop()
         if hasattr(col, prepare_exc):
             delattr(col, prepare_exc)
-    setup_state.stack = list()
+        try:
+            setup_state._teardown_with_finalization(col)
+        except TEST_OUTCOME:
+            # teardown of a failed setup attempt is never reported
+            pass
+
+
+def _remove_failed_setup_state_from_stack(item, stack):
+    """
+    Note: same for pytest>=7, whose _setupstate keeps the finalizers and the
+    setup error of every collector in a dict from the session to the item
+    """
+    nodes = list(stack)
+    failed = [index for index, node in enumerate(nodes)
+              if stack[node][1] is not None or node is item]
+    if not failed:
+        return
+    while len(stack) > failed[0]:
+        node, (finalizers, _) = stack.popitem()
+        while finalizers:
+            finalizer = finalizers.pop()
+            try:
+                finalizer()
+            except TEST_OUTCOME:
+                # teardown of a failed setup attempt is never reported
+                pass
+
+
+def _teardown_exact(item, nextitem):
+    setup_state = item.session._setupstate
+    if isinstance(setup_state.stack, dict):
+        setup_state.teardown_exact(nextitem)
+    else:
+        setup_state.teardown_exact(item, nextitem)
+
+
+def _teardown_towards(item, nextitem):
+    """
+    Note: tear the collectors and fixtures which ``nextitem`` doesn't need
+    down for an item that didn't run in this process, returns the report of
+    a failing teardown
+    """
+    if item.session.shouldfail or item.session.shouldstop:
+        nextitem = None
+    call = CallInfo.from_call(functools.partial(_teardown_exact, item, nextitem), 'teardown')
+    if call.excinfo is None:
+        return None
+    report = item.ihook.pytest_runtest_makereport(item=item, call=call)
+    report.failed_to_verify = False
+    return report
+
+
+def _forget_finalizers(item):
+    """
+    Note: drop the finalizers of the collectors and fixtures set up so far,
+    so that a forked process only tears down what it set up itself and
+    leaves the rest to its parent
+    """
+    setup_state = item.session._setupstate
+    stack = setup_state.stack
+    if isinstance(stack, dict):
+        for node, (_, exc) in list(stack.items()):
+            stack[node] = ([], exc)
+    else:
+        for node in stack:
+            setup_state._finalizers.pop(node, None)
+    for fixture_defs in item.session._fixturemanager._arg2fixturedefs.values():
+        for fixture_def in fixture_defs:
+            if getattr(fixture_def, 'cached_result', None) is not None:
+                # finishing a fixture requested again only resets its result
+                fixture_def._finalizers = []
 
 
 def _clear_cache(parallel, report, item):
-    if not parallel or works_with_current_xdist():
+    # cleanin item's cashed results from the failed levels of setup only
+    start = time.time()
+    _remove_failed_setup_state_from_session(item)
+    _remove_cached_results_from_failed_fixtures(item._failed_fixturedefs)
+    report.clear_duration = time.time() - start
+
+    if not parallel or item.config._works_with_current_xdist:
         # will rerun test, log intermediate result
         item.ihook.pytest_runtest_logreport(report=report)
 
-    # cleanin item's cashed results from any level of setups
-    _remove_cached_results_from_failed_fixtures(item)
-    _remove_failed_setup_state_from_session(item)
+
+def _wait_before_rerun(delay):
+    if delay > 0:
+        time.sleep(delay)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_fixture_setup(fixturedef, request):
+    item = getattr(request, '_pyfuncitem', None)
+    durations = getattr(item, '_setup_fixture_durations', None)
+    timeout = _get_fixture_setting(fixturedef, 'timeout')
+    finalizers = len(getattr(fixturedef, '_finalizers', None) or ())
+    start = time.time()
+    with _setup_timeout(timeout, "fixture %r" % (fixturedef.argname,)):
+        outcome = yield
+    _retry_teardown_finalizers(request.config, fixturedef, finalizers)
+    failed = getattr(item, '_setup_failed_fixturedefs', None)
+    if failed is not None and outcome.excinfo is not None:
+        failed.append(fixturedef)
+    memo_key = _get_memo_key(fixturedef, request)
+    if memo_key is not None and outcome.excinfo is None:
+        request.config._setup_memo.put(memo_key, outcome.get_result())
+    if durations is None:
+        return
+    key = _fixture_key(fixturedef)
+    durations[key] = durations.get(key, 0.0) + time.time() - start
+
+
+def _get_cache_key(fixturedef, request):
+    cache_key = getattr(fixturedef, 'cache_key', None)
+    if cache_key is None:  # older pytest keys by param_index
+        return request.param_index
+    return cache_key(request)
+
+
+def _resolve_fixture_function(fixturedef, request):
+    try:
+        from _pytest.fixtures import resolve_fixture_function
+    except ImportError:  # pytest < 3.5
+        return fixturedef.func
+    return resolve_fixture_function(fixturedef, request)
+
+
+def _get_memo_key(fixturedef, request):
+    """Returns the key under which the result of a reusable ``fixturedef`` is
+    shared by the parametrizations of the test requesting it: the test without
+    its parameters, the fixture and the indices of the parameters the fixture
+    depends on. None when the result is not to be shared.
+    """
+    if not _get_fixture_setting(fixturedef, 'reusable') or fixturedef.scope != 'function':
+        return None
+    item = getattr(request, '_pyfuncitem', None)
+    callspec = getattr(item, 'callspec', None)
+    if callspec is None:
+        return None
+    name2fixturedefs = getattr(getattr(item, '_fixtureinfo', None), 'name2fixturedefs', {})
+    argnames = set([fixturedef.argname])
+    pending = list(fixturedef.argnames)
+    while pending:
+        argname = pending.pop()
+        if argname in argnames:
+            continue
+        argnames.add(argname)
+        fixture_defs = name2fixturedefs.get(argname)
+        if fixture_defs:
+            pending.extend(fixture_defs[-1].argnames)
+    params = tuple(sorted((argname, index) for argname, index in callspec.indices.items() if argname in argnames))
+    return item.nodeid.split('[')[0], _fixture_key(fixturedef), params
+
+
+def _rerun_setup_needed(item, report):
+    """Returns whether the setup of ``item`` that produced ``report`` has to be
+    re-run.
+    """
+    if report.passed or report.skipped and not hasattr(report, 'wasxfail'):
+        return False
+    if getattr(item, '_setup_circuit_probe', False):
+        # a single attempt is enough to tell whether the fixture recovered
+        return False
+    rerun_setup = get_rerun_setup_count(item, item._failed_fixturedefs)
+    return (item.execution_count <= rerun_setup and
+            _rerun_budget_available(item.session.config))
+
+
+def pytest_collection_modifyitems(session, config, items):
+    """Moves the items whose setup is expected to cost most in re-runs to the
+    front, so that their re-runs overlap with the rest of the session. Under
+    pytest-xdist they are handed out to the workers first.
+    """
+    history = getattr(config, '_setup_history', None)
+    if history is None or not _get_option(config, 'rerun_setup_flaky_first'):
+        return
+    risks = dict((item, history.get_setup_risk(item.nodeid, _get_fixture_keys(item))) for item in items)
+    # stable, items without a recorded risk keep their order
+    items.sort(key=lambda item: tuple(-value for value in risks[item]))
+
+
+def _rerun_setup_deferred(item):
+    # xdist schedules items on its own, re-runs stay inline on the workers
+    return bool(_get_option(item.config, 'rerun_setup_deferred') and
+                _get_workerinput(item.config) is None)
+
+
+def _defer_setup_rerun(item, failed_fixturedefs):
+    session = item.session
+    if not hasattr(session, '_rerun_setup_queue'):
+        session._rerun_setup_queue = []
+    item._rerun_setup_group = tuple(sorted(fixturedef.argname for fixturedef in failed_fixturedefs))
+    item._rerun_setup_is_deferred = True
+    session._rerun_setup_queue.append(item)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtestloop(session):
+    outcome = yield
+    if outcome.excinfo is None:
+        _run_deferred_setup_reruns(session)
+
+
+def _run_deferred_setup_reruns(session):
+    """Re-runs the items whose failed setup was deferred, in rounds, until
+    they pass or run out of re-runs. Items failing on the same fixtures run
+    next to each other.
+    """
+    queue = getattr(session, '_rerun_setup_queue', [])
+    while queue and not (session.shouldfail or session.shouldstop):
+        order = dict((item, index) for index, item in enumerate(session.items))
+        items = sorted(queue, key=lambda item: (item._rerun_setup_group, order.get(item, 0)))
+        session._rerun_setup_queue = queue = []
+
+        delay = max(get_rerun_setup_delay(item) for item in items)
+        if delay > 0:
+            time.sleep(delay)
+
+        for index, item in enumerate(items):
+            nextitem = items[index + 1] if index + 1 < len(items) else None
+            item.config.hook.pytest_runtest_protocol(item=item, nextitem=nextitem)
+            if session.shouldfail or session.shouldstop:
+                break
+
+
+def _runtestprotocol(item, nextitem):
+    """Same as ``runtestprotocol`` without logging, except that a setup which
+    is going to be re-run right away is neither called nor torn down, so that
+    the successfully set up collectors and fixtures survive until the re-run.
+    Returns the reports and whether the setup has to be re-run.
+    """
+    hasrequest = hasattr(item, "_request")
+    if hasrequest and not item._request:
+        item._initrequest()
+    try:
+        if getattr(item.config, '_setup_costs', None) is not None:
+            item._setup_fixture_durations = {}
+        item._setup_failed_fixturedefs = failed = []
+        with _setup_timeout(get_rerun_setup_timeout(item), "setup of %s" % (item.nodeid,)):
+            rep = call_and_report(item, "setup", log=False)
+        item._setup_failed_fixturedefs = None
+        if getattr(item, '_setup_fixture_durations', None) is not None:
+            rep.fixture_durations = item._setup_fixture_durations
+            item._setup_fixture_durations = None
+        reports = [rep]
+        # remember what failed before a teardown invalidates the fixtures
+        item._failed_fixturedefs = [] if rep.passed else failed or _get_failed_fixturedefs(item)
+        rerun = _rerun_setup_needed(item, rep)
+        if not rerun or _rerun_setup_deferred(item):
+            if rep.passed:
+                setup_only = item.config.getoption("setuponly", False)
+                if item.config.getoption("setupshow", False):
+                    _show_test_item(item, setup_only)
+                if not setup_only:
+                    reports.append(call_and_report(item, "call", log=False))
+            # if the session is about to fail or stop, tear everything down
+            if item.session.shouldfail or item.session.shouldstop:
+                nextitem = None
+            item.config._teardown_reruns = 0
+            teardown = call_and_report(item, "teardown", log=False, nextitem=nextitem)
+            teardown.teardown_reruns = item.config._teardown_reruns
+            if teardown.teardown_reruns and teardown.passed:
+                teardown.outcome = 'teardown rerun'
+            reports.append(teardown)
+    finally:
+        # after all teardown hooks have been called
+        # want funcargs and request info to go away
+        if hasrequest:
+            item._request = False
+            item.funcargs = None
+    return reports, rerun
+
+
+def _show_test_item(item, setup_only):
+    """Call ``show_test_item``, which takes ``add_space`` as of pytest 8."""
+    try:
+        parameters = inspect.signature(show_test_item).parameters
+    except AttributeError:  # Python 2
+        parameters = ()
+    if 'add_space' in parameters:
+        show_test_item(item, add_space=not setup_only)
+    else:
+        show_test_item(item)
+
+
+def _run_forked(item, nextitem):
+    """Same as ``_runtestprotocol`` in a forked process, which starts from a
+    copy of this interpreter without the threads of the attempts before and
+    takes whatever the attempt leaves behind with it when it exits. Fixtures
+    set up by the attempt only exist in the forked process, which tears them
+    all down before it exits; this process then tears down towards
+    ``nextitem`` what was set up before.
+    """
+    config = item.config
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            _forget_finalizers(item)
+            reports, rerun = _runtestprotocol(item, None)
+            try:
+                # a setup that is going to be re-run wasn't torn down
+                _teardown_exact(item, None)
+            except TEST_OUTCOME:
+                # teardown of a failed setup attempt is never reported
+                pass
+            data = {
+                'reports': [config.hook.pytest_report_to_serializable(config=config, report=report)
+                            for report in reports],
+                'rerun': rerun,
+                'failed_fixtures': [_fixture_key(fixturedef) for fixturedef in item._failed_fixturedefs],
+            }
+            with os.fdopen(write_fd, 'wb') as forked_file:
+                pickle.dump(data, forked_file, 2)
+            status = 0
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as forked_file:
+        data = forked_file.read()
+    _, status = os.waitpid(pid, 0)
+    if not data:
+        longrepr = "setup re-run crashed in forked process %d with exit status %d" % (pid, status)
+        report = TestReport(item.nodeid, item.location,
+                            dict((keyword, 1) for keyword in item.keywords),
+                            'failed', longrepr, 'setup')
+        item._failed_fixturedefs = []
+        reports, rerun = [report], _rerun_setup_needed(item, report)
+    else:
+        data = pickle.loads(data)
+        reports = [config.hook.pytest_report_from_serializable(config=config, data=report_data)
+                   for report_data in data['reports']]
+        rerun = data['rerun']
+        failed = set(data['failed_fixtures'])
+        name2fixturedefs = getattr(getattr(item, '_fixtureinfo', None), 'name2fixturedefs', {})
+        item._failed_fixturedefs = [fixturedef for fixturedefs in name2fixturedefs.values()
+                                    for fixturedef in fixturedefs if _fixture_key(fixturedef) in failed]
+    if not rerun or _rerun_setup_deferred(item):
+        teardown = _teardown_towards(item, nextitem)
+        if teardown is not None:
+            if reports[-1].when != 'teardown':
+                reports.append(teardown)
+            elif not _failed(reports[-1]):
+                reports[-1] = teardown
+    return reports, rerun
 
 
 def pytest_runtest_protocol(item, nextitem):
@@ -129,49 +1268,72 @@ def pytest_runtest_protocol(item, nextitem):
     # while this doesn't need to be run with every item, it will fail on the
     # first item if necessary
     check_options(item.session.config)
-    parallel = hasattr(item.config, 'slaveinput')
-    item.execution_count = 0
+    parallel = _get_workerinput(item.config) is not None
+    breaker = getattr(item.config, '_setup_circuit_breaker', None)
+    if breaker is not None:
+        open_circuit = breaker.check(item)
+        if open_circuit is not None:
+            breaker.report_open_circuit(item, open_circuit, nextitem)
+            return True
+    deferred = _rerun_setup_deferred(item)
+    if getattr(item, '_rerun_setup_is_deferred', False):
+        # deferred re-run, keep counting the executions of the first run
+        item._rerun_setup_is_deferred = False
+    else:
+        item.execution_count = 0
 
     need_to_run = True
     while need_to_run:
         item.execution_count += 1
         item.ihook.pytest_runtest_logstart(nodeid=item.nodeid,
                                            location=item.location)
-        reports = runtestprotocol(item, nextitem=nextitem, log=False)
+        if item.config._rerun_setup_forked and item.execution_count > 1:
+            reports, rerun = _run_forked(item, nextitem)
+        else:
+            reports, rerun = _runtestprotocol(item, nextitem)
+        if breaker is not None:
+            breaker.record(item, reports[0])
 
         for report in reports:  # 3 reports: setup, call, teardown
             report.failed_to_verify = False
             if report.when == 'setup':
                 report.rerun = item.execution_count - 1
+                report.failed_fixtures = [_fixture_key(fixturedef) for fixturedef in item._failed_fixturedefs]
+                if item.config._setup_history is not None:
+                    report.history_fixtures = item.config._setup_history.get_history_fixtures(item)
                 xfail = hasattr(report, 'wasxfail')
 
-                if item.execution_count > rerun_setup and _failed(report):
+                if rerun and deferred:
+                    # the item was torn down already, re-run it at the end
+                    report.outcome = 'setup rerun'
+                    _consume_rerun_budget(item.session.config)
+                    _defer_setup_rerun(item, item._failed_fixturedefs)
+                    _clear_cache(parallel, report, item)
+
+                elif rerun:
+                    report.outcome = 'setup rerun'
+                    report.rerun_delay = get_rerun_setup_delay(item)
+                    _consume_rerun_budget(item.session.config)
+                    _clear_cache(parallel, report, item)
+                    _wait_before_rerun(report.rerun_delay)
+                    break  # trigger rerun
+
+                elif _failed(report):
                     # last run and failure detected on setup
                     report.failed_to_verify = True
                     item.ihook.pytest_runtest_logreport(report=report)
 
-                elif item.execution_count > rerun_setup and _passed(report) or report.skipped and not xfail:
-                    # last run and no failure detected, log normally
-                    item.ihook.pytest_runtest_logreport(report=report)
-
-                elif item.execution_count > rerun_setup and xfail and not report.passed:
+                elif xfail and not report.passed:
                     # last run and setup failed on xfail (remove any xfail traces, otherwise pytest exits with code 0)
                     report.outcome = 'failed'
                     report.failed_to_verify = True
                     del report.wasxfail
                     item.ihook.pytest_runtest_logreport(report=report)
 
-                elif item.execution_count > rerun_setup:
-                    item.ihook.pytest_runtest_logreport(report=report)
-
-                elif report.passed:
-                    item.ihook.pytest_runtest_logreport(report=report)
-
                 else:
-                    report.outcome = 'setup rerun'
-                    _clear_cache(parallel, report, item)
-                    break  # trigger rerun
-            else:
+                    item.ihook.pytest_runtest_logreport(report=report)
+            elif not (rerun and deferred and report.passed):
+                # the deferred re-run logs the item's teardown once it ran
                 item.ihook.pytest_runtest_logreport(report=report)
         else:
             need_to_run = False
@@ -181,6 +1343,758 @@ def pytest_runtest_protocol(item, nextitem):
     return True
 
 
+class SetupCircuitBreaker(object):
+    """Counts consecutive setup failures of every fixture across items. Once a
+    fixture failed ``threshold`` times in a row its circuit opens and the items
+    using it fail to verify without running. After ``cooldown`` seconds the
+    circuit is half-open: the next item runs a single attempt, closing the
+    circuit when its setup passes and opening it again when it fails.
+
+    With ``signals`` set, failures and state changes are shared with the other
+    processes (e.g. pytest-xdist workers) writing to the same signals file.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = {}
+        self.opened = {}
+        self.signals = None
+
+    def _apply(self, signal):
+        key = signal['fixture']
+        if signal['event'] == 'failed':
+            self.failures[key] = self.failures.get(key, 0) + 1
+        elif signal['event'] == 'opened':
+            self.failures[key] = max(self.failures.get(key, 0), self.threshold)
+            self.opened[key] = signal['time']
+        elif signal['event'] == 'closed':
+            self.failures.pop(key, None)
+            self.opened.pop(key, None)
+
+    def _publish(self, key, event, when):
+        if self.signals is not None:
+            self.signals.publish(key, event, when)
+
+    def check(self, item):
+        """Returns the key of an open circuit ``item`` depends on, or None."""
+        if self.signals is not None:
+            for setup_signal in self.signals.poll():
+                self._apply(setup_signal)
+        item._setup_circuit_probe = False
+        for key in _get_fixture_keys(item):
+            opened = self.opened.get(key)
+            if opened is None:
+                continue
+            if time.time() - opened < self.cooldown:
+                return key
+            item._setup_circuit_probe = True
+        return None
+
+    def record(self, item, report):
+        now = time.time()
+        if report.passed:
+            for key in _get_fixture_keys(item):
+                self.failures.pop(key, None)
+                if self.opened.pop(key, None) is not None:
+                    self._publish(key, 'closed', now)
+            return
+        for fixturedef in item._failed_fixturedefs:
+            key = _fixture_key(fixturedef)
+            self.failures[key] = self.failures.get(key, 0) + 1
+            self._publish(key, 'failed', now)
+            if self.failures[key] >= self.threshold or key in self.opened:
+                self.opened[key] = now
+                self._publish(key, 'opened', now)
+
+    def report_open_circuit(self, item, key, nextitem):
+        longrepr = ("circuit breaker open for fixture %r after %d consecutive setup failures"
+                    % (key, self.failures[key]))
+        report = TestReport(item.nodeid, item.location,
+                            dict((keyword, 1) for keyword in item.keywords),
+                            'failed', longrepr, 'setup')
+        report.rerun = 0
+        report.failed_to_verify = True
+        item.ihook.pytest_runtest_logstart(nodeid=item.nodeid, location=item.location)
+        item.ihook.pytest_runtest_logreport(report=report)
+        teardown = _teardown_towards(item, nextitem)
+        if teardown is not None:
+            item.ihook.pytest_runtest_logreport(report=teardown)
+        item.ihook.pytest_runtest_logfinish(nodeid=item.nodeid, location=item.location)
+
+
+class FailedToVerifyLimit(object):
+    """Stops the session once ``limit`` items, or a share of the collected
+    items when it ends with ``%``, failed to verify, or once ``rate`` of the
+    last ``window`` items failed to verify. Under pytest-xdist it only runs on
+    the controller, which stops the workers.
+    """
+
+    def __init__(self, config, limit=None, rate=None, window=50):
+        self.config = config
+        self.limit_text = limit
+        self.percentage = limit is not None and str(limit).endswith('%')
+        try:
+            self.limit = None if limit is None else float(str(limit).rstrip('%'))
+            if self.limit is not None and self.limit < 0:
+                raise ValueError(limit)
+        except ValueError:
+            raise pytest.UsageError("invalid --max-failed-to-verify %r, expected a number "
+                                    "or a percentage like '10%%'" % (limit,))
+        if rate is not None and not 0 <= rate <= 1:
+            raise pytest.UsageError("invalid --max-failed-to-verify-rate %r, expected a rate "
+                                    "between 0 and 1" % (rate,))
+        if window < 1:
+            raise pytest.UsageError("invalid --failed-to-verify-window %r, expected a positive "
+                                    "number of items" % (window,))
+        # like --maxfail, 0 disables the limits
+        self.limit = self.limit or None
+        self.rate = rate or None
+        self.recent = deque(maxlen=window)
+        self.count = 0
+        self.session = None
+
+    def pytest_sessionstart(self, session):
+        self.session = session
+
+    def check(self):
+        """Returns why the session has to stop, or None."""
+        if self.limit is not None:
+            collected = getattr(self.session, 'testscollected', 0) or len(getattr(self.session, 'items', []))
+            limit = self.limit * collected / 100.0 if self.percentage else self.limit
+            if collected and self.count >= limit:
+                return ("%d of %d items failed to verify, reaching --max-failed-to-verify %s"
+                        % (self.count, collected, self.limit_text))
+        if self.rate is not None and len(self.recent) == self.recent.maxlen:
+            rate = float(sum(self.recent)) / len(self.recent)
+            if rate >= self.rate:
+                return ("%d of the last %d items failed to verify, reaching --max-failed-to-verify-rate %s"
+                        % (sum(self.recent), len(self.recent), self.rate))
+        return None
+
+    def pytest_runtest_logreport(self, report):
+        if report.when != 'setup' or report.outcome == 'setup rerun' or self.session is None:
+            return
+        failed_to_verify = getattr(report, 'failed_to_verify', False)
+        self.count += int(failed_to_verify)
+        self.recent.append(int(failed_to_verify))
+        reason = self.check()
+        if reason and not self.session.shouldstop:
+            self.session.shouldstop = reason
+            dsession = self.config.pluginmanager.getplugin('dsession')
+            if dsession is not None:
+                dsession.shouldstop = reason
+
+
+class SetupHistory(object):
+    """Setup outcomes of the last ``window`` runs of every test and fixture
+    that had a failing setup, kept in ``config.cache``. Every run is recorded
+    as ``[failed attempts, recovered, failed to verify, setup seconds]``.
+    pytest-xdist workers only read the history to pick re-run counts and the
+    order of the tests; the controller records the runs.
+    """
+
+    cache_key = 'pytest_failed_to_verify/history'
+
+    def __init__(self, config, window):
+        self.config = config
+        self.window = window
+        self.worker = _get_workerinput(config) is not None
+        history = config.cache.get(self.cache_key, {})
+        self.nodeids = history.get('nodeids', {})
+        self.fixtures = history.get('fixtures', {})
+        self.running = {}
+        self.nodeid_runs = {}
+        self.fixture_runs = {}
+
+    def get_rerun_count(self, nodeid, fixture_keys=()):
+        """Returns the number of re-runs the history suggests: as many as were
+        needed to recover, 0 when the setup failed in every recorded run and
+        never recovered, or None when the history does not tell.
+        """
+        counts = [self._rerun_count(self.fixtures.get(key, [])) for key in fixture_keys]
+        counts = [count for count in counts if count is not None]
+        if counts:
+            return max(counts)
+        return self._rerun_count(self.nodeids.get(nodeid, []))
+
+    def get_history_fixtures(self, item):
+        """Returns the keys of the fixtures of ``item`` with a recorded
+        history, which record every run of the item to keep their window
+        moving.
+        """
+        if not self.fixtures:
+            return []
+        return [key for key in _get_fixture_keys(item) if key in self.fixtures]
+
+    def get_setup_risk(self, nodeid, fixture_keys=()):
+        """Returns the seconds the setup of ``nodeid`` spent in runs with
+        failed attempts per recorded run, and the share of runs with failed
+        attempts. The riskiest of the test and its fixtures counts.
+        """
+        histories = [self.nodeids.get(nodeid, [])] + [self.fixtures.get(key, []) for key in fixture_keys]
+        return max(self._setup_risk(runs) for runs in histories)
+
+    @staticmethod
+    def _setup_risk(runs):
+        if not runs:
+            return 0.0, 0.0
+        failed = [duration for attempts, recovered, failed_to_verify, duration in runs if attempts]
+        return sum(failed) / len(runs), float(len(failed)) / len(runs)
+
+    @staticmethod
+    def _rerun_count(runs):
+        recovered = [attempts for attempts, recovered, failed_to_verify, duration in runs if recovered]
+        if recovered:
+            return max(recovered)
+        if len(runs) >= 2 and all(failed_to_verify for attempts, recovered, failed_to_verify, duration in runs):
+            return 0
+        return None
+
+    def pytest_runtest_logreport(self, report):
+        if report.when != 'setup' or self.worker:
+            return
+        attempts, duration, fixtures = self.running.pop(report.nodeid, (0, 0.0, set()))
+        duration += getattr(report, 'duration', 0.0)
+        fixtures.update(getattr(report, 'failed_fixtures', ()))
+        if report.outcome == 'setup rerun':
+            self.running[report.nodeid] = (attempts + 1, duration, fixtures)
+            return
+
+        failed_to_verify = getattr(report, 'failed_to_verify', False)
+        if failed_to_verify:
+            attempts += 1
+        recovered = bool(attempts) and not failed_to_verify
+        if attempts or report.nodeid in self.nodeids:
+            self.nodeid_runs[report.nodeid] = [attempts, recovered, failed_to_verify, duration]
+        for key in fixtures:
+            run = self.fixture_runs.setdefault(key, [0, False, False, 0.0])
+            run[0] = max(run[0], attempts)
+            run[1] = run[1] or recovered
+            run[2] = run[2] or failed_to_verify
+            run[3] += duration
+        for key in getattr(report, 'history_fixtures', ()):
+            if key not in fixtures:
+                run = self.fixture_runs.setdefault(key, [0, False, False, 0.0])
+                run[3] += duration
+
+    def pytest_sessionfinish(self, session):
+        if not self.nodeid_runs and not self.fixture_runs:
+            return
+        for history, runs in ((self.nodeids, self.nodeid_runs), (self.fixtures, self.fixture_runs)):
+            for key, run in runs.items():
+                history[key] = (history.get(key, []) + [run])[-self.window:]
+        self.config.cache.set(self.cache_key, {'nodeids': self.nodeids, 'fixtures': self.fixtures})
+
+
+class LastFailedToVerify(object):
+    """Keeps the node ids of the items that failed to verify in their last run
+    in ``config.cache``, and with ``--ftv-last`` deselects all other items at
+    collection, like ``--lf`` does for failures. Items that are not run keep
+    their entry. pytest-xdist workers only deselect, the controller records.
+    """
+
+    cache_key = 'pytest_failed_to_verify/lastfailedtoverify'
+
+    def __init__(self, config):
+        self.config = config
+        self.worker = _get_workerinput(config) is not None
+        self.active = config.getoption('ftv_last')
+        self.last_failed_to_verify = config.cache.get(self.cache_key, {})
+        self.changed = False
+        self.status = None
+
+    def pytest_runtest_logreport(self, report):
+        if report.when != 'setup' or report.outcome == 'setup rerun' or self.worker:
+            return
+        if getattr(report, 'failed_to_verify', False):
+            self.changed = self.changed or report.nodeid not in self.last_failed_to_verify
+            self.last_failed_to_verify[report.nodeid] = True
+        elif self.last_failed_to_verify.pop(report.nodeid, None):
+            self.changed = True
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_collection_modifyitems(self, session, config, items):
+        if not self.active:
+            return
+        if not self.last_failed_to_verify:
+            self.status = "no previously failed to verify tests, running all %d" % len(items)
+            return
+        selected = [item for item in items if item.nodeid in self.last_failed_to_verify]
+        deselected = [item for item in items if item.nodeid not in self.last_failed_to_verify]
+        self.status = "rerunning %d items that failed to verify, deselected %d" % (len(selected), len(deselected))
+        if deselected:
+            config.hook.pytest_deselected(items=deselected)
+            items[:] = selected
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_report_collectionfinish(self, config):
+        if self.status and config.getoption('verbose') >= 0:
+            return "run-last-failed-to-verify: %s" % self.status
+
+    def pytest_sessionfinish(self, session):
+        if not self.changed:
+            return
+        self.config.cache.set(self.cache_key, self.last_failed_to_verify)
+
+
+class SetupCosts(object):
+    """Time spent in the setup phase per fixture and per item, collected from
+    the setup reports. The retry overhead of an item is
+    the time of its re-run setup attempts, of clearing their failed state and
+    of the delays before the re-runs. Shows the ``top`` most costly fixtures and
+    items in the terminal summary and writes everything to ``json_path``.
+    """
+
+    def __init__(self, config, top, json_path=None):
+        self.config = config
+        self.top = top
+        self.json_path = json_path
+        self.start = time.time()
+        self.fixtures = {}
+        self.items = {}
+
+    @property
+    def retry_overhead(self):
+        return sum(costs['retry_overhead'] for costs in self.items.values())
+
+    def pytest_runtest_logreport(self, report):
+        if report.when != 'setup':
+            return
+        rerun = report.outcome == 'setup rerun'
+        for key, duration in getattr(report, 'fixture_durations', {}).items():
+            costs = self.fixtures.setdefault(key, {'setups': 0, 'duration': 0.0, 'retry_duration': 0.0})
+            costs['setups'] += 1
+            costs['duration'] += duration
+            if rerun:
+                costs['retry_duration'] += duration
+
+        costs = self.items.setdefault(report.nodeid, {'attempts': 0, 'duration': 0.0, 'retry_overhead': 0.0})
+        costs['attempts'] += 1
+        costs['duration'] += getattr(report, 'duration', 0.0)
+        if rerun:
+            costs['retry_overhead'] += (getattr(report, 'duration', 0.0) +
+                                        getattr(report, 'clear_duration', 0.0) +
+                                        getattr(report, 'rerun_delay', 0.0))
+
+    def to_json(self):
+        return {
+            'session_duration': time.time() - self.start,
+            'retry_overhead': self.retry_overhead,
+            'fixtures': self.fixtures,
+            'items': self.items,
+        }
+
+    def pytest_sessionfinish(self, session):
+        if not self.json_path or _get_workerinput(self.config) is not None:
+            return
+        with open(self.json_path, 'w') as json_file:
+            json.dump(self.to_json(), json_file, indent=2, sort_keys=True)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.top <= 0 or not self.items:
+            return
+        tr = terminalreporter
+        session_duration = time.time() - self.start
+        tr._tw.sep("=", "setup cost summary info")
+        tr._tw.line("retry overhead: %.2fs of %.2fs session time (%.1f%%)"
+                    % (self.retry_overhead, session_duration,
+                       100.0 * self.retry_overhead / session_duration if session_duration else 0.0))
+
+        fixtures = sorted(self.fixtures.items(), key=lambda entry: -entry[1]['duration'])[:self.top]
+        if fixtures:
+            tr._tw.line("most costly fixtures:")
+            tr._tw.line("%9s %9s %8s  %s" % ('total', 'retried', 'setups', 'fixture'))
+        for key, costs in fixtures:
+            tr._tw.line("%8.2fs %8.2fs %8d  %s"
+                        % (costs['duration'], costs['retry_duration'], costs['setups'], key))
+
+        items = sorted(self.items.items(), key=lambda entry: -entry[1]['duration'])[:self.top]
+        tr._tw.line("most costly items:")
+        tr._tw.line("%9s %9s %8s  %s" % ('total', 'retried', 'attempts', 'item'))
+        for nodeid, costs in items:
+            tr._tw.line("%8.2fs %8.2fs %8d  %s"
+                        % (costs['duration'], costs['retry_overhead'], costs['attempts'], nodeid))
+
+
+class CompactRerunReports(object):
+    """Replaces the failure of every logged ``setup rerun`` report with a one
+    line summary once the other plugins have seen it, and drops its captured
+    output. Identical tracebacks share a single summary, so that the reports
+    kept by the terminal reporter stay small however often setups are re-run,
+    and so do the ones pytest-xdist workers send to the controller.
+    """
+
+    max_length = 200
+
+    def __init__(self):
+        self.summaries = {}
+
+    def summarize(self, report):
+        text = report.longreprtext
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        summary = self.summaries.get(digest)
+        if summary is None:
+            crash = getattr(report.longrepr, 'reprcrash', None)
+            if crash is not None:
+                summary = "%s:%d: %s" % (crash.path, crash.lineno, crash.message)
+            else:
+                summary = text.strip().splitlines()[-1] if text.strip() else ''
+            summary = self.summaries[digest] = summary[:self.max_length]
+        return summary
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_runtest_logreport(self, report):
+        if report.outcome != 'setup rerun' or report.longrepr is None:
+            return
+        report.longrepr = self.summarize(report)
+        report.sections = []
+
+    @pytest.hookimpl(hookwrapper=True, optionalhook=True)
+    def pytest_report_to_serializable(self, config, report):
+        """Sends re-run setups as light attempt records with the summary of
+        their failure instead of the whole traceback, captured output and
+        keywords. Serialization happens before the report is compacted for
+        the terminal reporter.
+        """
+        outcome = yield
+        data = outcome.get_result()
+        if data is None or getattr(report, 'outcome', None) != 'setup rerun' or report.longrepr is None:
+            return
+        data.update(longrepr=self.summarize(report), sections=[], keywords={})
+
+
+class SetupMemo(object):
+    """Results of reusable fixtures, evicting the least recently used ones
+    beyond ``size`` results.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.results = OrderedDict()
+
+    def get(self, key):
+        result = self.results.pop(key, None)
+        if result is not None:
+            self.results[key] = result
+        return result
+
+    def put(self, key, result):
+        if result is None or self.size <= 0:
+            return
+        self.results.pop(key, None)
+        self.results[key] = result
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_fixture_setup(self, fixturedef, request):
+        """Hands out the shared result of a reusable fixture instead of
+        setting it up again.
+        """
+        memo_key = _get_memo_key(fixturedef, request)
+        if memo_key is None:
+            return None
+        result = self.get(memo_key)
+        if result is not None:
+            fixturedef.cached_result = (result, _get_cache_key(fixturedef, request), None)
+        return result
+
+
+class Spare(object):
+    """An instance of a fixture set up in the background with ``kwargs``."""
+
+    def __init__(self, kwargs):
+        self.kwargs = kwargs
+        self.value = None
+        self.generator = None
+        self.failed = False
+        self.thread = None
+
+    def matches(self, kwargs):
+        return (set(self.kwargs) == set(kwargs) and
+                all(self.kwargs[name] is kwargs[name] for name in kwargs))
+
+
+def _finish_spare(generator):
+    try:
+        next(generator)
+    except StopIteration:
+        pass
+    else:
+        raise ValueError("fixture function with spares has more than one 'yield'")
+
+
+class SparePool(object):
+    """Spare instances of the fixtures annotated with ``flaky_setup(spares=N)``.
+    Whenever such a fixture is set up, threads set up spares until ``N`` of
+    them wait for the same dependencies, at most ``threads`` at a time. A
+    re-run of the setup takes a spare instead of setting the fixture up again.
+    Spares are torn down when they no longer match the dependencies, and when
+    the scope of the fixture ends.
+    """
+
+    def __init__(self, threads):
+        self.semaphore = threading.BoundedSemaphore(max(threads, 1))
+        self.spares = {}
+        self.item_keys = []
+
+    def build(self, spare, func):
+        with self.semaphore:
+            try:
+                if inspect.isgeneratorfunction(func):
+                    spare.generator = func(**spare.kwargs)
+                    spare.value = next(spare.generator)
+                else:
+                    spare.value = func(**spare.kwargs)
+            except Exception:
+                spare.failed = True
+
+    def fill(self, key, fixturedef, node, func, kwargs, count):
+        spares = self.spares.get(key)
+        if spares is None:
+            spares = self.spares[key] = []
+            if fixturedef.scope == 'function':
+                # the failed setup state of an item is torn down before a re-run
+                self.item_keys.append(key)
+            else:
+                # the finalizers of the failed fixture are called before a re-run
+                node.addfinalizer(functools.partial(self.evict, key))
+        for spare in [spare for spare in spares if not spare.matches(kwargs)]:
+            spares.remove(spare)
+            self.teardown([spare])
+        while len(spares) < count:
+            spare = Spare(kwargs)
+            spare.thread = threading.Thread(target=self.build, args=(spare, func),
+                                            name='rerun-setup-spare-%s' % (fixturedef.argname,))
+            spare.thread.daemon = True
+            spare.thread.start()
+            spares.append(spare)
+
+    def take(self, key, kwargs):
+        """Returns a spare set up with ``kwargs``, waiting for it to be ready,
+        or None when none could be set up.
+        """
+        spares = self.spares.get(key, [])
+        for spare in [spare for spare in spares if spare.matches(kwargs)]:
+            spares.remove(spare)
+            spare.thread.join()
+            if not spare.failed:
+                return spare
+        return None
+
+    def teardown(self, spares):
+        exc_info = None
+        for spare in spares:
+            spare.thread.join()
+            if spare.generator is None or spare.failed:
+                continue
+            try:
+                _finish_spare(spare.generator)
+            except Exception:
+                exc_info = exc_info or sys.exc_info()
+        if exc_info is not None:
+            raise exc_info[1]
+
+    def evict(self, key):
+        self.teardown(self.spares.pop(key, []))
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_fixture_setup(self, fixturedef, request):
+        """Hands out a spare on a re-run of the setup and sets up new spares
+        in the background.
+        """
+        count = _get_fixture_setting(fixturedef, 'spares')
+        if not count:
+            return None
+        key = (_fixture_key(fixturedef), request.param_index)
+        kwargs = dict((argname, request.getfixturevalue(argname)) for argname in fixturedef.argnames)
+        item = getattr(request, '_pyfuncitem', None)
+        spare = None
+        if getattr(item, 'execution_count', 0) > 1:
+            spare = self.take(key, kwargs)
+        self.fill(key, fixturedef, request.node, _resolve_fixture_function(fixturedef, request), kwargs, count)
+        if spare is None:
+            return None
+        fixturedef.cached_result = (spare.value, _get_cache_key(fixturedef, request), None)
+        if spare.generator is not None:
+            fixturedef.addfinalizer(functools.partial(_finish_spare, spare.generator))
+        return spare.value
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_teardown(self, item):
+        yield
+        keys, self.item_keys = self.item_keys, []
+        for key in keys:
+            self.evict(key)
+
+
+class SetupMetrics(object):
+    """Counts setup attempts, re-runs, recoveries and items failing to verify,
+    and the time every re-run cost per failing fixture, in a Prometheus text
+    file. The file is replaced at most every ``interval`` seconds while the
+    session runs and at its end, so that a textfile collector never reads it
+    half written. Only registered on the pytest-xdist controller.
+    """
+
+    buckets = (0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.written = 0.0
+        self.counters = {'attempts': 0, 'reruns': 0, 'recoveries': 0, 'failed_to_verify': 0}
+        self.fixture_failures = {}
+        self.retry_seconds = {}
+
+    def observe(self, fixture, seconds):
+        histogram = self.retry_seconds.setdefault(fixture, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram['buckets'][index] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    def pytest_runtest_logreport(self, report):
+        if report.when != 'setup':
+            return
+        self.counters['attempts'] += 1
+        if report.outcome == 'setup rerun':
+            self.counters['reruns'] += 1
+            seconds = (getattr(report, 'duration', 0.0) + getattr(report, 'clear_duration', 0.0) +
+                       getattr(report, 'rerun_delay', 0.0))
+            for fixture in getattr(report, 'failed_fixtures', None) or ['']:
+                self.fixture_failures[fixture] = self.fixture_failures.get(fixture, 0) + 1
+                self.observe(fixture, seconds)
+        elif getattr(report, 'failed_to_verify', False):
+            self.counters['failed_to_verify'] += 1
+            for fixture in getattr(report, 'failed_fixtures', None) or ['']:
+                self.fixture_failures[fixture] = self.fixture_failures.get(fixture, 0) + 1
+        elif getattr(report, 'rerun', 0):
+            self.counters['recoveries'] += 1
+        if time.time() - self.written >= self.interval:
+            self.write()
+
+    def pytest_sessionfinish(self, session):
+        self.write()
+
+    @staticmethod
+    def _label(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        lines = []
+        for name, help_text in (('attempts', 'Setup attempts.'),
+                                ('reruns', 'Setup attempts that failed and were re-run.'),
+                                ('recoveries', 'Items whose setup passed after re-runs.'),
+                                ('failed_to_verify', 'Items that failed to verify.')):
+            metric = 'pytest_setup_%s_total' % name
+            lines.extend(['# HELP %s %s' % (metric, help_text), '# TYPE %s counter' % metric,
+                          '%s %d' % (metric, self.counters[name])])
+
+        metric = 'pytest_setup_fixture_failures_total'
+        lines.extend(['# HELP %s Failed setup attempts per failing fixture.' % metric, '# TYPE %s counter' % metric])
+        for fixture, count in sorted(self.fixture_failures.items()):
+            lines.append('%s{fixture="%s"} %d' % (metric, self._label(fixture), count))
+
+        metric = 'pytest_setup_retry_seconds'
+        lines.extend(['# HELP %s Seconds a re-run setup attempt cost per failing fixture.' % metric,
+                      '# TYPE %s histogram' % metric])
+        for fixture, histogram in sorted(self.retry_seconds.items()):
+            label = self._label(fixture)
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                lines.append('%s_bucket{fixture="%s",le="%s"} %d' % (metric, label, bound, count))
+            lines.append('%s_bucket{fixture="%s",le="+Inf"} %d' % (metric, label, histogram['count']))
+            lines.append('%s_sum{fixture="%s"} %f' % (metric, label, histogram['sum']))
+            lines.append('%s_count{fixture="%s"} %d' % (metric, label, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        self.written = time.time()
+        partial = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(partial, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        # os.rename does not replace an existing file on windows
+        if os.path.exists(self.path) and os.name == 'nt':
+            os.remove(self.path)
+        os.rename(partial, self.path)
+
+
+class SetupEventLog(object):
+    """Streams every logged test report as a JSON line, including the setup
+    re-run attempts with their ``rerun`` index and ``failed_to_verify`` flag.
+    The file is line buffered, so it can be followed while the session runs,
+    and nothing is kept in memory. Under pytest-xdist the controller writes the
+    reports of all workers, tagged with the ``worker`` they came from.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.logfile = open(path, 'w', buffering=1)
+
+    def write(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        self.logfile.write(json.dumps(fields, sort_keys=True) + '\n')
+
+    def pytest_sessionstart(self, session):
+        self.write('sessionstart')
+
+    def pytest_runtest_logreport(self, report):
+        node = getattr(report, 'node', None)
+        fields = {
+            'nodeid': report.nodeid,
+            'when': report.when,
+            'outcome': report.outcome,
+            'rerun': getattr(report, 'rerun', 0),
+            'failed_to_verify': getattr(report, 'failed_to_verify', False),
+            'duration': getattr(report, 'duration', 0.0),
+            'worker': getattr(getattr(node, 'gateway', None), 'id', None),
+        }
+        if not report.passed and report.longrepr is not None:
+            fields['longrepr'] = report.longreprtext
+        self.write('report', **fields)
+
+    def pytest_sessionfinish(self, session, exitstatus):
+        self.write('sessionfinish', exitstatus=int(exitstatus))
+
+    def pytest_unconfigure(self, config):
+        self.logfile.close()
+
+
+class SetupSignals(object):
+    """Append-only JSON lines file shared by processes to exchange setup
+    failure and recovery signals. Every line is written with a single append,
+    so that concurrent writers never interleave.
+    """
+
+    def __init__(self, path, source=None):
+        self.path = path
+        self.source = source or str(os.getpid())
+        self.offset = 0
+
+    def publish(self, key, event, when):
+        line = json.dumps({'fixture': key, 'event': event, 'time': when, 'source': self.source})
+        with open(self.path, 'a') as signals_file:
+            signals_file.write(line + '\n')
+
+    def poll(self):
+        """Returns the signals published by other processes since the last
+        poll.
+        """
+        try:
+            with open(self.path, 'rb') as signals_file:
+                signals_file.seek(self.offset)
+                data = signals_file.read()
+        except (IOError, OSError):
+            return []
+        # a line still being written is picked up by the next poll
+        data = data[:data.rfind(b'\n') + 1]
+        self.offset += len(data)
+        signals = [json.loads(line.decode('utf-8')) for line in data.splitlines() if line]
+        return [signal for signal in signals if signal['source'] != self.source]
+
+
 def _passed(report):
     return report.passed and not report.failed and not report.skipped
 
@@ -196,26 +2110,75 @@ def pytest_report_teststatus(report):
         return 'setup rerun', 'SR', ('SETUP RERUN',
                                      {'yellow': True})
 
+    if report.outcome == 'teardown rerun':
+        return 'teardown rerun', 'TR', ('TEARDOWN RERUN',
+                                        {'yellow': True})
+
     if report.failed_to_verify:
         return 'failed to verify', 'F2V', ('FAILED TO VERIFY',
                                  {'red': True})
 
 
+def _failure_signature(report):
+    """Returns the traceback of ``report`` without the parts that differ
+    between items failing the same way: the pytest-xdist worker header and
+    object addresses.
+    """
+    lines = [line for line in report.longreprtext.splitlines() if not re.match(r'\[gw\d+\] ', line)]
+    return re.sub(r'0x[0-9a-fA-F]+', '0x?', '\n'.join(lines)).strip()
+
+
+def _group_failed_to_verify(reports):
+    """Returns the failing fixtures and the reports of ``reports`` with the
+    same traceback signature and failing fixtures, in order of appearance.
+    """
+    groups = {}
+    order = []
+    for report in reports:
+        fixtures = tuple(sorted(getattr(report, 'failed_fixtures', ())))
+        key = (_failure_signature(report), fixtures)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(report)
+    return [(key[1], groups[key]) for key in order]
+
+
+def _write_failed_to_verify(path, groups):
+    with open(path, 'w') as json_file:
+        json.dump({'groups': [{'fixtures': list(fixtures),
+                               'count': len(reports),
+                               'nodeids': [report.nodeid for report in reports],
+                               'longrepr': reports[0].longreprtext}
+                              for fixtures, reports in groups]},
+                  json_file, indent=2, sort_keys=True)
+
+
 def pytest_terminal_summary(terminalreporter):
     """Adapted from https://pytest.org/latest/_modules/_pytest/skipping.html
+    Items failing to verify with the same traceback on the same fixtures are
+    shown once, with the number of items and a few of their node ids.
     """
     tr = terminalreporter
+    failed_to_verify = tr.stats.get("failed to verify")
+    groups = _group_failed_to_verify(failed_to_verify or [])
+    json_path = tr.config.getoption('rerun_setup_failures_json')
+    if json_path:
+        _write_failed_to_verify(json_path, groups)
     if not tr.reportchars:
         return
 
-    failed_to_verify = tr.stats.get("failed to verify")
     lines = []
-
-    if failed_to_verify:
-        for rep in failed_to_verify:
-            pos = rep.nodeid
-            lines.append("FAILED TO VERIFY %s" % (pos,))
-            lines.append(rep.longreprtext)
+    for fixtures, reports in groups:
+        if len(reports) == 1:
+            lines.append("FAILED TO VERIFY %s" % (reports[0].nodeid,))
+        else:
+            on_fixtures = " on %s" % ", ".join(fixtures) if fixtures else ""
+            lines.append("FAILED TO VERIFY %d items%s" % (len(reports), on_fixtures))
+            lines.extend("    %s" % (report.nodeid,) for report in reports[:SUMMARY_SAMPLES])
+            if len(reports) > SUMMARY_SAMPLES:
+                lines.append("    ... and %d more" % (len(reports) - SUMMARY_SAMPLES))
+        lines.append(reports[0].longreprtext)
 
     if lines:
         tr._tw.sep("=", "setup rerun test summary info")
@@ -223,28 +2186,36 @@ def pytest_terminal_summary(terminalreporter):
             tr._tw.line(line)
 
 
-class RerunResultLog(ResultLog):
-    def __init__(self, config, logfile):
-        ResultLog.__init__(self, config, logfile)
+def _make_rerun_result_log(config, logfile):
+    """Returns the legacy ``--resultlog`` plugin for pytest < 6, superseded by
+    ``--rerun-setup-log``. ``_pytest.resultlog`` is only imported when the
+    option is used.
+    """
+    from _pytest.resultlog import ResultLog
+
+    class RerunResultLog(ResultLog):
+        rerun_setup = True
 
-    def pytest_runtest_logreport(self, report):
-        """
-        Adds support for rerun report fix for issue:
-        https://github.com/pytest-dev/pytest-rerunfailures/issues/28
-        """
-        if report.when != "call" and report.passed:
-            return
-        res = self.config.hook.pytest_report_teststatus(report=report)
-        code = res[1]
-        if code == 'x':
-            longrepr = str(report.longrepr)
-        elif code == 'X':
-            longrepr = ''
-        elif report.passed:
-            longrepr = ""
-        elif report.failed:
-            longrepr = str(report.longrepr)
-        elif report.skipped:
-            longrepr = str(report.longrepr[2])
-
-        self.log_outcome(report, code, longrepr)
+        def pytest_runtest_logreport(self, report):
+            """
+            Adds support for rerun report fix for issue:
+            https://github.com/pytest-dev/pytest-rerunfailures/issues/28
+            """
+            if report.when != "call" and report.passed:
+                return
+            res = self.config.hook.pytest_report_teststatus(report=report)
+            code = res[1]
+            if code == 'x':
+                longrepr = str(report.longrepr)
+            elif code == 'X':
+                longrepr = ''
+            elif report.passed:
+                longrepr = ""
+            elif report.failed or report.outcome == 'setup rerun':
+                longrepr = str(report.longrepr)
+            elif report.skipped:
+                longrepr = str(report.longrepr[2])
+
+            self.log_outcome(report, code, longrepr)
+
+    return RerunResultLog(config, logfile)
@@ -0,0 +1,50 @@
+"""Retries of coroutine fixtures inside the running event loop, kept apart so
+that the plugin itself does not import asyncio and stays importable on
+Python 2.
+"""
+import asyncio
+import functools
+import inspect
+
+
+async def _attempt(awaitable, timeout):
+    if timeout is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, timeout)
+
+
+def retry_coroutine_fixture(func, retries, timeout):
+    """Returns ``func`` retrying its setup up to ``retries`` times in the event
+    loop it runs in, every attempt limited to ``timeout`` seconds. For async
+    generator fixtures only the part up to the ``yield`` is retried.
+    """
+    retries = retries or 0
+
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(retries + 1):
+                generator = func(*args, **kwargs)
+                try:
+                    value = await _attempt(generator.__anext__(), timeout)
+                    break
+                except Exception:
+                    await generator.aclose()
+                    if attempt == retries:
+                        raise
+            yield value
+            try:
+                await generator.__anext__()
+            except StopAsyncIteration:
+                pass
+        return wrapper
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        for attempt in range(retries + 1):
+            try:
+                return await _attempt(func(*args, **kwargs), timeout)
+            except Exception:
+                if attempt == retries:
+                    raise
+    return wrapper
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import codecs
 from setuptools import setup
 
@@ -11,6 +12,12 @@ def read(fname):
     return codecs.open(file_path, encoding='utf-8').read()
 
 
+py_modules = ['pytest_failed_to_verify']
+if sys.version_info >= (3, 6):
+    # retries of coroutine fixtures use async generators
+    py_modules.append('pytest_failed_to_verify_async')
+
+
 setup(
     name='pytest-failed-to-verify',
     version='0.1.5',
@@ -22,7 +29,7 @@ setup(
     url='https://github.com/gastrofix-gmbh/pytest-failed-to-verify',
     description='A pytest plugin that helps better distinguishing real test failures from setup flakiness.',
     long_description=read('README.rst'),
-    py_modules=['pytest_failed_to_verify'],
+    py_modules=py_modules,
     python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*',
     install_requires=['pytest>=4.1.0'],
     classifiers=[
@@ -1,7 +1,17 @@
+import json
+import os
+import signal
+import sys
+import time
+
 import pytest
+from _pytest import hookspec
 
 pytest_plugins = 'pytester'
 
+needs_report_serialization = pytest.mark.skipif(not hasattr(hookspec, 'pytest_report_to_serializable'),
+                                                reason="needs pytest>=4.4")
+
 
 def temporary_failure():
     return "raise Exception('Failure')"
@@ -117,7 +127,8 @@ def test_failed_in_output_on_error_in_test_logic(pytest_command, testdir):
     )
     result = testdir.runpytest(*pytest_command.split())
     assert 'setup rerun' not in result.stdout.str()
-    assert 'FAILED' not in result.stdout.str()
+    # pytest>=6 lists failures as FAILED in the short test summary by default
+    assert 'FAILED TO VERIFY' not in result.stdout.str()
     assert '1 failed' in result.stdout.str()
 
     assert 'falied to verify' not in result.stdout.str()
@@ -228,3 +239,1471 @@ def test_xfail_and_setup_failure(pytest_command, testdir):
     assert 'Exception: Failure' in result.stdout.str()
 
     assert result.ret == 1
+
+
+@pytest.mark.parametrize("pytest_command, expected_delays", [
+    ('--rerun-setup 3 --rerun-setup-delay 0.5', [0.5, 0.5, 0.5]),
+    ('--rerun-setup 3 --rerun-setup-delay 0.5 --rerun-setup-backoff exponential', [0.5, 1.0, 2.0]),
+    ('--rerun-setup 3 --rerun-setup-delay 0.5 --rerun-setup-backoff exponential --rerun-setup-max-delay 1.5', [0.5, 1.0, 1.5]),
+])
+def test_delay_between_setup_reruns(pytest_command, expected_delays, testdir, monkeypatch):
+    delays = []
+    monkeypatch.setattr('time.sleep', delays.append)
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope='function', autouse=True)
+        def function_setup_teardown():
+            {0}
+
+        def test_example_1():
+            assert True
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest(*pytest_command.split())
+    assert '3 setup rerun' in result.stdout.str()
+    assert '1 failed to verify' in result.stdout.str()
+    assert delays == expected_delays
+
+
+def test_jitter_delay_stays_within_bounds(testdir, monkeypatch):
+    delays = []
+    monkeypatch.setattr('time.sleep', delays.append)
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.flaky(reruns_delay=0.1, backoff='jitter')
+        def test_example_1():
+            assert True
+        """
+    )
+    testdir.makeconftest(
+        """
+        import pytest
+
+        @pytest.fixture(autouse=True)
+        def function_setup_teardown():
+            {0}
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('--rerun-setup', '4', '--rerun-setup-max-delay', '1')
+    assert '4 setup rerun' in result.stdout.str()
+    assert len(delays) == 4
+    assert all(0.1 <= delay <= 1 for delay in delays)
+
+
+def test_rerun_budget_is_shared_by_the_session(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope='function', autouse=True)
+        def function_setup_teardown():
+            {0}
+
+        def test_example_1():
+            assert True
+
+        def test_example_2():
+            assert True
+        """.format(temporary_failure())
+    )
+    testdir.makeini(
+        """
+        [pytest]
+        rerun_setup_budget = 1
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '2')
+    assert '1 setup rerun' in result.stdout.str()
+    assert '2 failed to verify' in result.stdout.str()
+    assert result.ret == 1
+
+
+def test_flaky_marker_overrides_global_rerun_count(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope='function', autouse=True)
+        def function_setup_teardown():
+            {0}
+
+        @pytest.mark.flaky(reruns=2)
+        def test_example_1():
+            assert True
+
+        @pytest.mark.flaky(reruns=0)
+        def test_example_2():
+            assert True
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('--rerun-setup', '1')
+    assert '2 setup rerun' in result.stdout.str()
+    assert '2 failed to verify' in result.stdout.str()
+
+
+def test_rerun_count_from_ini_nodeid_globs(testdir):
+    testdir.makepyfile(
+        test_db="""
+        import pytest
+
+        @pytest.fixture(scope='function', autouse=True)
+        def function_setup_teardown():
+            {0}
+
+        def test_example_1():
+            assert True
+        """.format(temporary_failure())
+    )
+    testdir.makeini(
+        """
+        [pytest]
+        rerun_setup_nodeids =
+            test_db.py::* 3
+            * 0
+        """
+    )
+    result = testdir.runpytest()
+    assert '3 setup rerun' in result.stdout.str()
+    assert '1 failed to verify' in result.stdout.str()
+
+
+def test_rerun_count_from_failed_fixture(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        from pytest_failed_to_verify import flaky_setup
+
+        @pytest.fixture
+        @flaky_setup(reruns=2)
+        def flaky_resource():
+            {0}
+
+        @flaky_setup(reruns=0)
+        @pytest.fixture
+        def broken_resource():
+            {0}
+
+        def test_example_1(flaky_resource):
+            assert True
+
+        def test_example_2(broken_resource):
+            assert True
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('--rerun-setup', '1')
+    assert '2 setup rerun' in result.stdout.str()
+    assert '2 failed to verify' in result.stdout.str()
+
+
+def test_rerun_keeps_successfully_set_up_fixtures(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        SETUPS = []
+        ATTEMPTS = []
+
+        def setup_module(module):
+            SETUPS.append('module')
+
+        @pytest.fixture(scope='session')
+        def expensive_resource():
+            SETUPS.append('session')
+
+        @pytest.fixture(scope='session')
+        def flaky_session_resource():
+            ATTEMPTS.append('session')
+            if len(ATTEMPTS) == 1:
+                {0}
+
+        @pytest.fixture
+        def flaky_resource(expensive_resource, flaky_session_resource):
+            ATTEMPTS.append('function')
+            if len(ATTEMPTS) < 4:
+                {0}
+
+        def test_example_1(flaky_resource):
+            assert sorted(SETUPS) == ['module', 'session']
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('--rerun-setup', '3')
+    assert '2 setup rerun' in result.stdout.str()
+    assert '1 passed' in result.stdout.str()
+    assert result.ret == 0
+
+
+def test_rerun_of_fixture_failing_before_its_result_is_cached(testdir):
+    testdir.makeconftest(
+        """
+        import pytest
+        CALLS = []
+
+        @pytest.hookimpl(tryfirst=True)
+        def pytest_fixture_setup(fixturedef, request):
+            if fixturedef.argname == 'resource':
+                CALLS.append(1)
+                if len(CALLS) == 1:
+                    raise Exception('Failure')
+        """
+    )
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def resource():
+            return 'resource'
+
+        def test_example_1(resource):
+            assert resource == 'resource'
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1')
+    assert '1 setup rerun' in result.stdout.str()
+    assert '1 passed' in result.stdout.str()
+    assert result.ret == 0
+
+
+@pytest.mark.parametrize("pytest_command, expected", [
+    ('--rerun-setup 1 --setup-show', '1 passed'),
+    ('--rerun-setup 1 --setup-only', 'no tests ran'),
+])
+def test_setup_show_with_setup_reruns(pytest_command, expected, testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def resource():
+            pass
+
+        def test_example_1(resource):
+            assert True
+        """
+    )
+    result = testdir.runpytest(*pytest_command.split())
+    assert 'SETUP    F resource' in result.stdout.str()
+    assert 'test_example_1 (fixtures used: ' in result.stdout.str()
+    assert expected in result.stdout.str()
+    assert 'INTERNALERROR' not in result.stdout.str()
+    assert result.ret == 0
+
+
+@pytest.mark.parametrize("pytest_command, expected", [
+    ('--rerun-setup 1', '1 failed to verify'),
+    ('--rerun-setup 1 --rerun-setup-deferred', '3 passed'),
+])
+def test_deferred_setup_reruns_run_after_the_session(pytest_command, expected, testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        SERVICE = {'down': True}
+
+        @pytest.fixture
+        def service():
+            if SERVICE['down']:
+                raise Exception('Failure')
+
+        def test_example_1(service):
+            assert True
+
+        def test_example_2():
+            SERVICE['down'] = False
+
+        def test_example_3(service):
+            assert True
+        """
+    )
+    result = testdir.runpytest('-v', *pytest_command.split())
+    assert '1 setup rerun' in result.stdout.str()
+    assert expected in result.stdout.str()
+
+
+def test_deferred_setup_reruns_are_reported_once(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        SERVICE = {'down': True}
+
+        @pytest.fixture
+        def service():
+            if SERVICE['down']:
+                raise Exception('Failure')
+
+        def test_example_1(service):
+            assert True
+
+        def test_example_2():
+            SERVICE['down'] = False
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1', '--rerun-setup-deferred', '--junitxml', 'junit.xml')
+    assert '2 passed' in result.stdout.str()
+    junit = testdir.tmpdir.join('junit.xml').read()
+    assert 'tests="2"' in junit
+    assert junit.count('<testcase ') == 2
+
+
+def test_deferred_setup_reruns_are_grouped_by_failing_fixture(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        CALLS = []
+
+        @pytest.fixture
+        def database():
+            CALLS.append('database')
+            if CALLS.count('database') < 3:
+                raise Exception('Failure')
+
+        @pytest.fixture
+        def broker():
+            CALLS.append('broker')
+            if CALLS.count('broker') < 3:
+                raise Exception('Failure')
+
+        def test_database_1(database):
+            assert True
+
+        def test_broker_1(broker):
+            assert True
+
+        def test_database_2(database):
+            assert True
+
+        def test_broker_2(broker):
+            assert True
+        """
+    )
+    result = testdir.runpytest('-v', '--rerun-setup', '1', '--rerun-setup-deferred')
+    assert '4 setup rerun' in result.stdout.str()
+    assert '4 passed' in result.stdout.str()
+    result.stdout.fnmatch_lines([
+        '*::test_broker_1 PASSED*',
+        '*::test_broker_2 PASSED*',
+        '*::test_database_1 PASSED*',
+        '*::test_database_2 PASSED*',
+    ])
+
+
+def test_circuit_breaker_stops_running_items_of_a_broken_fixture(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        CALLS = []
+
+        @pytest.fixture
+        def service():
+            CALLS.append(1)
+            {0}
+
+        @pytest.mark.parametrize('index', range(5))
+        def test_example_1(service, index):
+            assert True
+
+        def test_example_2():
+            assert len(CALLS) == 2
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('--rerun-setup', '1', '--rerun-setup-circuit-breaker', '2', '-rf')
+    assert '1 setup rerun' in result.stdout.str()
+    assert '5 failed to verify' in result.stdout.str()
+    assert '1 passed' in result.stdout.str()
+    result.stdout.fnmatch_lines(["circuit breaker open for fixture '*::service' after 2 consecutive setup failures"])
+
+
+def test_circuit_breaker_tears_down_items_it_does_not_run(testdir):
+    testdir.makepyfile(
+        test_m1="""
+        import pytest
+
+        def setup_module(module):
+            print('setup m1')
+
+        def teardown_module(module):
+            print('teardown m1')
+
+        @pytest.fixture
+        def service():
+            {0}
+
+        @pytest.mark.parametrize('index', range(3))
+        def test_example_1(service, index):
+            assert True
+        """.format(temporary_failure()),
+        test_m2="""
+        def test_example_2():
+            assert True
+        """
+    )
+    result = testdir.runpytest('-s', '--rerun-setup', '1', '--rerun-setup-circuit-breaker', '2')
+    assert '3 failed to verify' in result.stdout.str()
+    assert '1 passed' in result.stdout.str()
+    assert result.stdout.str().count('teardown m1') == 1
+    assert 'not torn down properly' not in result.stdout.str()
+
+
+def test_circuit_breaker_probes_for_recovery(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        CALLS = []
+
+        @pytest.fixture
+        def service():
+            CALLS.append(1)
+            if len(CALLS) <= 3:
+                raise Exception('Failure')
+
+        @pytest.mark.parametrize('index', range(4))
+        def test_example_1(service, index):
+            assert True
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1', '--rerun-setup-circuit-breaker', '2',
+                               '--rerun-setup-circuit-cooldown', '0')
+    assert '1 setup rerun' in result.stdout.str()
+    assert '2 failed to verify' in result.stdout.str()
+    assert '2 passed' in result.stdout.str()
+
+
+def test_circuit_opened_by_another_process_is_shared(testdir):
+    signals = testdir.tmpdir.join('signals.jsonl')
+    signals.write('{"fixture": "test_circuit_opened_by_another_process_is_shared.py::service", '
+                  '"event": "opened", "time": %f, "source": "gw1"}\n' % time.time())
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def service():
+            assert False, 'fixture must not be set up while its circuit is open'
+
+        def test_example_1(service):
+            assert True
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1', '--rerun-setup-circuit-breaker', '2',
+                               '--rerun-setup-signals', str(signals))
+    assert '1 failed to verify in' in result.stdout.str()
+
+
+def test_circuit_breaker_signals_are_shared_between_xdist_workers(testdir):
+    pytest.importorskip('xdist')
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def service():
+            {0}
+
+        @pytest.mark.parametrize('index', range(10))
+        def test_example_1(service, index):
+            assert True
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('-n', '2', '--rerun-setup', '1', '--rerun-setup-circuit-breaker', '2')
+    assert '10 failed to verify' in result.stdout.str()
+
+
+def test_adaptive_reruns_skip_deterministic_setup_failures(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def service():
+            {0}
+
+        def test_example_1(service):
+            assert True
+        """.format(temporary_failure())
+    )
+    for _ in range(2):
+        result = testdir.runpytest('--rerun-setup', '2')
+        assert '2 setup rerun' in result.stdout.str()
+    result = testdir.runpytest('--rerun-setup', '2', '--rerun-setup-adaptive')
+    assert '1 failed to verify in' in result.stdout.str()
+
+
+def test_adaptive_reruns_follow_recovered_setups(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        CALLS = []
+
+        @pytest.fixture
+        def service():
+            CALLS.append(1)
+            if len(CALLS) <= 2:
+                raise Exception('Failure')
+
+        def test_example_1(service):
+            assert True
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '5')
+    assert '2 setup rerun' in result.stdout.str()
+    result = testdir.runpytest('--rerun-setup-adaptive')
+    assert '2 setup rerun' in result.stdout.str()
+    assert '1 passed' in result.stdout.str()
+
+
+def test_adaptive_reruns_recover_after_the_failure_went_away(testdir):
+    testdir.makepyfile(
+        """
+        import os
+        import pytest
+        CALLS = []
+
+        @pytest.fixture
+        def service():
+            CALLS.append(1)
+            if os.path.exists('broken') or (os.path.exists('flaky') and len(CALLS) == 1):
+                raise Exception('Failure')
+
+        def test_example_1(service):
+            assert True
+        """
+    )
+    testdir.tmpdir.join('broken').write('')
+    for _ in range(2):
+        result = testdir.runpytest('--rerun-setup', '2')
+        assert '1 failed to verify in' in result.stdout.str()
+    testdir.tmpdir.join('broken').remove()
+    result = testdir.runpytest('--rerun-setup', '2', '--rerun-setup-adaptive')
+    assert '1 passed in' in result.stdout.str()
+
+    testdir.tmpdir.join('flaky').write('')
+    result = testdir.runpytest('--rerun-setup', '2', '--rerun-setup-adaptive')
+    assert '1 passed, 1 setup rerun' in result.stdout.str()
+
+
+def test_setup_costs_summary_and_json(testdir):
+    testdir.makepyfile(
+        """
+        import time
+        import pytest
+        CALLS = []
+
+        @pytest.fixture
+        def service():
+            CALLS.append(1)
+            time.sleep(0.1)
+            if len(CALLS) == 1:
+                raise Exception('Failure')
+
+        def test_example_1(service):
+            assert True
+
+        def test_example_2():
+            assert True
+        """
+    )
+    costs = testdir.tmpdir.join('costs.json')
+    result = testdir.runpytest('--rerun-setup', '1', '--rerun-setup-delay', '0.1',
+                               '--rerun-setup-costs', '1', '--rerun-setup-costs-json', str(costs))
+    assert '1 setup rerun' in result.stdout.str()
+    assert '2 passed' in result.stdout.str()
+    result.stdout.fnmatch_lines([
+        '*= setup cost summary info =*',
+        'retry overhead: *s of *s session time (*%)',
+        'most costly fixtures:',
+        '    total   retried   setups  fixture',
+        '*s *s        2  test_setup_costs_summary_and_json.py::service',
+        'most costly items:',
+        '    total   retried attempts  item',
+        '*s *s        2  test_setup_costs_summary_and_json.py::test_example_1',
+    ])
+    assert 'test_example_2' not in result.stdout.str()
+
+    data = json.loads(costs.read())
+    fixture = data['fixtures']['test_setup_costs_summary_and_json.py::service']
+    assert fixture['setups'] == 2
+    assert fixture['duration'] >= 0.2
+    assert 0.1 <= fixture['retry_duration'] < fixture['duration']
+    item = data['items']['test_setup_costs_summary_and_json.py::test_example_1']
+    assert item['attempts'] == 2
+    assert item['retry_overhead'] >= 0.2
+    assert data['retry_overhead'] == item['retry_overhead']
+
+
+def test_setup_event_log_streams_every_report(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def service():
+            {0}
+
+        def test_example_1(service):
+            assert True
+
+        def test_example_2():
+            assert True
+        """.format(temporary_failure())
+    )
+    log = testdir.tmpdir.join('events.jsonl')
+    result = testdir.runpytest('--rerun-setup', '2', '--rerun-setup-log', str(log))
+    assert '1 failed to verify' in result.stdout.str()
+
+    events = [json.loads(line) for line in log.readlines()]
+    assert events[0]['event'] == 'sessionstart'
+    assert events[-1] == dict(events[-1], event='sessionfinish', exitstatus=1)
+    setups = [(event['rerun'], event['outcome'], event['failed_to_verify']) for event in events
+              if event['event'] == 'report' and event['when'] == 'setup' and 'test_example_1' in event['nodeid']]
+    assert setups == [(0, 'setup rerun', False), (1, 'setup rerun', False), (2, 'failed', True)]
+    assert all('Exception: Failure' in event['longrepr'] for event in events
+               if event['event'] == 'report' and event['when'] == 'setup' and 'test_example_1' in event['nodeid'])
+    assert len([event for event in events if event['event'] == 'report']) == 7
+
+
+def test_plugin_import_time(testdir):
+    script = testdir.makepyfile(
+        """
+        import sys
+        import time
+
+        import pytest
+
+        sys.path.insert(0, {0!r})
+        modules = set(sys.modules)
+        start = time.time()
+        import pytest_failed_to_verify
+        print('import time: %.3fs' % (time.time() - start))
+        for module in ('pkg_resources', '_pytest.resultlog'):
+            assert module in modules or module not in sys.modules, module
+        """.format(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    )
+    result = testdir.run(sys.executable, str(script))
+    assert result.ret == 0, result.stderr.str()
+    # a generous bound, only meant to catch heavy imports coming back
+    import_time = float(result.stdout.str().split('import time: ')[1].split('s')[0])
+    assert import_time < 5
+
+
+def test_resultlog_with_setup_reruns(testdir):
+    pytest.importorskip('_pytest.resultlog')
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def service():
+            {0}
+
+        def test_example_1(service):
+            assert True
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('--rerun-setup', '1', '--resultlog', 'result.log')
+    assert '1 failed to verify' in result.stdout.str()
+    lines = testdir.tmpdir.join('result.log').readlines()
+    assert [line[:3] for line in lines if not line.startswith(' ')] == ['SR ', 'F2V']
+
+
+def test_compact_reports_of_setup_reruns(testdir):
+    testdir.makeconftest(
+        """
+        def pytest_terminal_summary(terminalreporter):
+            reruns = terminalreporter.stats['setup rerun']
+            print('interned longreprs: %d' % len(set(id(report.longrepr) for report in reruns)))
+            print('rerun longrepr: %s' % reruns[0].longrepr)
+        """
+    )
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def service():
+            print('captured output')
+            {0}
+
+        def test_example_1(service):
+            assert True
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('--rerun-setup', '3', '--rerun-setup-compact-reports')
+    assert '3 setup rerun' in result.stdout.str()
+    assert '1 failed to verify' in result.stdout.str()
+    result.stdout.fnmatch_lines([
+        'interned longreprs: 1',
+        'rerun longrepr: *test_compact_reports_of_setup_reruns.py:6: Exception: Failure',
+    ])
+    # the final report keeps its whole traceback
+    result.stdout.fnmatch_lines(['FAILED TO VERIFY *::test_example_1', '*def service():*'])
+
+
+def test_failed_to_verify_summary_groups_identical_failures(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def service():
+            {0}
+
+        @pytest.fixture
+        def database():
+            raise Exception('Database down')
+
+        @pytest.mark.parametrize('index', range(5))
+        def test_example_1(service, index):
+            assert True
+
+        def test_example_2(database):
+            assert True
+        """.format(temporary_failure())
+    )
+    failures = testdir.tmpdir.join('failures.json')
+    result = testdir.runpytest('--rerun-setup', '1', '-rf', '--rerun-setup-failures-json', str(failures))
+    assert '6 failed to verify' in result.stdout.str()
+    result.stdout.fnmatch_lines([
+        'FAILED TO VERIFY 5 items on test_failed_to_verify_summary_groups_identical_failures.py::service',
+        '    *::test_example_1[[]0[]]',
+        '    *::test_example_1[[]1[]]',
+        '    *::test_example_1[[]2[]]',
+        '    ... and 2 more',
+        '*Exception: Failure',
+        'FAILED TO VERIFY *::test_example_2',
+        '*Exception: Database down',
+    ])
+    assert result.stdout.str().count('E       Exception: Failure') == 1
+
+    groups = json.loads(failures.read())['groups']
+    assert [(group['fixtures'], group['count']) for group in groups] == [
+        (['test_failed_to_verify_summary_groups_identical_failures.py::service'], 5),
+        (['test_failed_to_verify_summary_groups_identical_failures.py::database'], 1),
+    ]
+    assert len(groups[0]['nodeids']) == 5
+
+
+@needs_report_serialization
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs os.fork")
+def test_forked_setup_reruns_start_from_a_clean_interpreter(testdir):
+    testdir.makepyfile(
+        """
+        import os
+        import threading
+        import pytest
+        PARENT = os.getpid()
+        LEAKED = []
+
+        @pytest.fixture
+        def service():
+            if not LEAKED:
+                LEAKED.append(threading.Thread(target=threading.Event().wait, args=(5,)))
+                LEAKED[0].daemon = True
+                LEAKED[0].start()
+                raise Exception('Failure')
+            assert os.getpid() != PARENT
+            assert threading.active_count() == 1
+
+        def test_example_1(service):
+            assert True
+
+        def test_example_2():
+            assert os.getpid() == PARENT
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '2', '--rerun-setup-forked')
+    assert '1 setup rerun' in result.stdout.str()
+    assert '2 passed' in result.stdout.str()
+
+
+@needs_report_serialization
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs os.fork")
+def test_forked_setup_reruns_report_failures(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def service():
+            {0}
+
+        def test_example_1(service):
+            assert True
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('--rerun-setup', '2', '--rerun-setup-forked', '-rf')
+    assert '2 setup rerun' in result.stdout.str()
+    assert '1 failed to verify' in result.stdout.str()
+    assert 'Exception: Failure' in result.stdout.str()
+
+
+@needs_report_serialization
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs os.fork")
+def test_forked_setup_reruns_tear_down_across_modules(testdir):
+    testdir.makeconftest(
+        """
+        import os
+        import pytest
+        PARENT = os.getpid()
+
+        def log(event):
+            process = 'parent' if os.getpid() == PARENT else 'child'
+            with open(os.path.join(os.path.dirname(__file__), 'events.log'), 'a') as events:
+                events.write('%s %s\\n' % (process, event))
+
+        @pytest.fixture(scope='session')
+        def session_resource():
+            log('session start')
+            yield
+            log('session stop')
+        """
+    )
+    testdir.makepyfile(
+        test_m1="""
+        import pytest
+        from conftest import log
+        CALLS = []
+
+        @pytest.fixture(scope='module', autouse=True)
+        def module_resource():
+            log('module start')
+            yield
+            log('module stop')
+
+        @pytest.fixture
+        def service(request):
+            CALLS.append(1)
+            if len(CALLS) == 1:
+                raise Exception('Failure')
+            request.getfixturevalue('session_resource')
+
+        def test_a(service):
+            assert True
+        """,
+        test_m2="""
+        from conftest import log
+
+        def test_c():
+            log('test_c')
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1', '--rerun-setup-forked')
+    assert '1 setup rerun' in result.stdout.str()
+    assert '2 passed' in result.stdout.str()
+    assert 'not torn down properly' not in result.stdout.str()
+    assert testdir.tmpdir.join('events.log').read().splitlines() == [
+        'parent module start',
+        'child session start',
+        'child session stop',
+        'parent module stop',
+        'parent test_c',
+    ]
+
+
+@pytest.mark.skipif(hasattr(hookspec, 'pytest_report_to_serializable'), reason="needs pytest<4.4")
+def test_forked_setup_reruns_need_report_serialization(testdir):
+    testdir.makepyfile(
+        """
+        def test_example_1():
+            assert True
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1', '--rerun-setup-forked')
+    result.stderr.fnmatch_lines(['*--rerun-setup-forked needs pytest>=4.4*'])
+
+
+def test_coroutine_fixture_retried_inside_the_event_loop(testdir):
+    pytest.importorskip('pytest_asyncio')
+    testdir.makepyfile(
+        """
+        import asyncio
+        import pytest
+        import pytest_asyncio
+        from pytest_failed_to_verify import flaky_setup
+        LOOPS = []
+        CALLS = []
+
+        @getattr(pytest_asyncio, 'fixture', pytest.fixture)
+        @flaky_setup(retries=3, timeout=0.5)
+        async def pool():
+            LOOPS.append(asyncio.get_event_loop())
+            CALLS.append(1)
+            if len(CALLS) == 1:
+                await asyncio.sleep(5)
+            if len(CALLS) == 2:
+                raise Exception('Failure')
+            return 'pool'
+
+        @pytest.mark.asyncio
+        async def test_example_1(pool):
+            assert pool == 'pool'
+            assert len(CALLS) == 3
+            assert LOOPS == [asyncio.get_event_loop()] * 3
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1')
+    assert 'setup rerun' not in result.stdout.str()
+    assert '1 passed' in result.stdout.str()
+
+
+def test_async_generator_fixture_retried_up_to_its_yield(testdir):
+    pytest.importorskip('pytest_asyncio')
+    testdir.makepyfile(
+        """
+        import pytest
+        import pytest_asyncio
+        from pytest_failed_to_verify import flaky_setup
+        EVENTS = []
+
+        @getattr(pytest_asyncio, 'fixture', pytest.fixture)
+        @flaky_setup(retries=1)
+        async def client():
+            EVENTS.append('open')
+            try:
+                if EVENTS.count('open') == 1:
+                    raise Exception('Failure')
+                yield 'client'
+            finally:
+                EVENTS.append('close')
+
+        @pytest.mark.asyncio
+        async def test_example_1(client):
+            assert client == 'client'
+
+        def test_example_2():
+            assert EVENTS == ['open', 'close', 'open', 'close']
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1')
+    assert '2 passed' in result.stdout.str()
+
+
+def test_flaky_setup_retries_need_a_coroutine_fixture():
+    from pytest_failed_to_verify import flaky_setup
+    with pytest.raises(TypeError):
+        flaky_setup(retries=1)(lambda: None)
+
+
+@pytest.mark.skipif(not hasattr(signal, 'setitimer'), reason="needs signal.setitimer")
+@pytest.mark.parametrize("pytest_command, marker", [
+    ('--rerun-setup 1 --rerun-setup-timeout 0.2', ''),
+    ('--rerun-setup 1', '@pytest.mark.flaky(setup_timeout=0.2)'),
+])
+def test_hanging_setup_is_interrupted_and_rerun(pytest_command, marker, testdir):
+    testdir.makepyfile(
+        """
+        import time
+        import pytest
+        CALLS = []
+
+        @pytest.fixture
+        def service():
+            CALLS.append(1)
+            if len(CALLS) == 1:
+                time.sleep(10)
+
+        {0}
+        def test_example_1(service):
+            assert True
+        """.format(marker)
+    )
+    start = time.time()
+    result = testdir.runpytest(*pytest_command.split())
+    assert '1 setup rerun' in result.stdout.str()
+    assert '1 passed' in result.stdout.str()
+    assert time.time() - start < 5
+
+
+@pytest.mark.skipif(not hasattr(signal, 'setitimer'), reason="needs signal.setitimer")
+def test_fixture_setup_timeout(testdir):
+    testdir.makepyfile(
+        """
+        import time
+        import pytest
+        from pytest_failed_to_verify import flaky_setup
+
+        @pytest.fixture
+        @flaky_setup(timeout=0.2)
+        def service():
+            time.sleep(10)
+
+        def test_example_1(service):
+            assert True
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1', '-rf')
+    assert '1 setup rerun' in result.stdout.str()
+    assert '1 failed to verify' in result.stdout.str()
+    assert "SetupTimeout: fixture 'service' exceeded the setup timeout of 0.2 seconds" in result.stdout.str()
+
+
+def test_reusable_fixture_is_shared_by_parametrized_siblings(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        from pytest_failed_to_verify import flaky_setup
+        CALLS = []
+
+        @pytest.fixture(params=['sqlite', 'postgres'])
+        def backend(request):
+            return request.param
+
+        @pytest.fixture
+        @flaky_setup(reusable=True)
+        def database(backend):
+            CALLS.append(backend)
+            if len(CALLS) == 1:
+                raise Exception('Failure')
+            return {'backend': backend}
+
+        @pytest.fixture
+        @flaky_setup(reusable=True)
+        def client():
+            return object()
+
+        CLIENTS = set()
+
+        @pytest.mark.parametrize('index', range(3))
+        def test_example_1(database, backend, client, index):
+            assert database['backend'] == backend
+            CLIENTS.add(client)
+
+        def test_example_2():
+            assert CALLS == ['sqlite', 'sqlite', 'postgres']
+            assert len(CLIENTS) == 1
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1')
+    assert '1 setup rerun' in result.stdout.str()
+    assert '7 passed' in result.stdout.str()
+
+
+def test_reusable_fixture_results_are_evicted(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        from pytest_failed_to_verify import flaky_setup
+        CALLS = []
+
+        @pytest.fixture(params=range(3))
+        def shard(request):
+            return request.param
+
+        @pytest.fixture
+        @flaky_setup(reusable=True)
+        def database(shard):
+            CALLS.append(shard)
+            return shard
+
+        @pytest.mark.parametrize('index', range(2))
+        def test_example_1(database, index):
+            assert True
+
+        def test_example_2():
+            assert len(CALLS) == 6
+        """
+    )
+    result = testdir.runpytest('--rerun-setup-reuse-size', '0')
+    assert '7 passed' in result.stdout.str()
+
+
+def test_flaky_setups_run_first(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        CALLS = []
+
+        @pytest.fixture
+        def service():
+            CALLS.append(1)
+            if len(CALLS) == 1:
+                raise Exception('Failure')
+
+        def test_example_1():
+            assert True
+
+        def test_example_2():
+            assert True
+
+        def test_example_3(service):
+            assert True
+        """
+    )
+    result = testdir.runpytest('-v', '--rerun-setup', '1', '--rerun-setup-flaky-first')
+    assert '1 setup rerun' in result.stdout.str()
+    result.stdout.fnmatch_lines(['*::test_example_1 PASSED*', '*::test_example_2 PASSED*', '*::test_example_3 PASSED*'])
+    result = testdir.runpytest('-v', '--rerun-setup', '1', '--rerun-setup-flaky-first')
+    result.stdout.fnmatch_lines(['*::test_example_3 PASSED*', '*::test_example_1 PASSED*', '*::test_example_2 PASSED*'])
+
+
+def test_flaky_setups_run_in_order_again_after_recovery(testdir):
+    testdir.makeini(
+        """
+        [pytest]
+        rerun_setup_history_window = 2
+        """
+    )
+    testdir.makepyfile(
+        """
+        import os
+        import pytest
+
+        @pytest.fixture
+        def service():
+            if os.path.exists('flaky'):
+                os.remove('flaky')
+                raise Exception('Failure')
+
+        def test_example_1():
+            assert True
+
+        def test_example_2(service):
+            assert True
+        """
+    )
+    testdir.tmpdir.join('flaky').write('')
+    result = testdir.runpytest('-v', '--rerun-setup', '1', '--rerun-setup-flaky-first')
+    assert '1 setup rerun' in result.stdout.str()
+    for _ in range(2):
+        result = testdir.runpytest('-v', '--rerun-setup', '1', '--rerun-setup-flaky-first')
+        result.stdout.fnmatch_lines(['*::test_example_2 PASSED*', '*::test_example_1 PASSED*'])
+    result = testdir.runpytest('-v', '--rerun-setup', '1', '--rerun-setup-flaky-first')
+    result.stdout.fnmatch_lines(['*::test_example_1 PASSED*', '*::test_example_2 PASSED*'])
+
+
+@pytest.mark.parametrize("pytest_command, failed_to_verify, reason", [
+    ('--max-failed-to-verify 3', 3, '3 of 10 items failed to verify, reaching --max-failed-to-verify 3'),
+    ('--max-failed-to-verify 20%', 2, '2 of 10 items failed to verify, reaching --max-failed-to-verify 20%'),
+    ('--max-failed-to-verify-rate 0.5 --failed-to-verify-window 4', 2,
+     '2 of the last 4 items failed to verify, reaching --max-failed-to-verify-rate 0.5'),
+])
+def test_session_stops_once_too_many_items_fail_to_verify(pytest_command, failed_to_verify, reason, testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def service():
+            {0}
+
+        def test_example_1():
+            assert True
+
+        def test_example_2():
+            assert True
+
+        @pytest.mark.parametrize('index', range(8))
+        def test_example_3(service, index):
+            assert True
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('--rerun-setup', '1', *pytest_command.split())
+    assert '%d failed to verify' % (failed_to_verify,) in result.stdout.str()
+    result.stdout.fnmatch_lines(['*Interrupted: %s*' % (reason,)])
+    assert result.ret != 0
+
+
+@pytest.mark.parametrize("pytest_command", [
+    '--max-failed-to-verify 0',
+    '--max-failed-to-verify 0%',
+    '--max-failed-to-verify-rate 0',
+])
+def test_zero_failed_to_verify_limits_are_disabled(pytest_command, testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.parametrize('index', range(3))
+        def test_example_1(index):
+            assert True
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1', *pytest_command.split())
+    assert '3 passed' in result.stdout.str()
+    assert 'Interrupted' not in result.stdout.str()
+    assert result.ret == 0
+
+
+@pytest.mark.parametrize("pytest_command, error", [
+    ('--max-failed-to-verify -1', "invalid --max-failed-to-verify '-1'*"),
+    ('--max-failed-to-verify many', "invalid --max-failed-to-verify 'many'*"),
+    ('--max-failed-to-verify-rate 1.5', 'invalid --max-failed-to-verify-rate 1.5*'),
+    ('--max-failed-to-verify-rate -0.5', 'invalid --max-failed-to-verify-rate -0.5*'),
+    ('--max-failed-to-verify-rate 0.5 --failed-to-verify-window 0', 'invalid --failed-to-verify-window 0*'),
+])
+def test_invalid_failed_to_verify_limits(pytest_command, error, testdir):
+    testdir.makepyfile(
+        """
+        def test_example_1():
+            assert True
+        """
+    )
+    result = testdir.runpytest('--rerun-setup', '1', *pytest_command.split())
+    result.stderr.fnmatch_lines(['*' + error])
+    assert result.ret != 0
+
+
+@needs_report_serialization
+@pytest.mark.parametrize("pytest_command, compact", [
+    ('--rerun-setup 1', False),
+    ('--rerun-setup 1 --rerun-setup-compact-reports', True),
+])
+def test_serialized_setup_rerun_reports(pytest_command, compact, testdir):
+    testdir.makeconftest(
+        """
+        import json
+        CONFIG = []
+
+        def pytest_configure(config):
+            CONFIG.append(config)
+
+        def pytest_runtest_logreport(report):
+            if report.when != 'setup':
+                return
+            config = CONFIG[0]
+            data = config.hook.pytest_report_to_serializable(config=config, report=report)
+            copy = config.hook.pytest_report_from_serializable(config=config, data=json.loads(json.dumps(data)))
+            print('serialized %s: rerun=%s failed_to_verify=%s failed_fixtures=%s longrepr=%r' % (
+                copy.outcome, copy.rerun, copy.failed_to_verify, copy.failed_fixtures,
+                copy.longreprtext.splitlines()[-1]))
+        """
+    )
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def service():
+            {0}
+
+        def test_example_1(service):
+            assert True
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('-s', *pytest_command.split())
+    assert '1 failed to verify' in result.stdout.str()
+    rerun_longrepr = ("*test_serialized_setup_rerun_reports.py:5: Exception: Failure'" if compact
+                      else "*test_serialized_setup_rerun_reports.py:5: Exception'")
+    result.stdout.fnmatch_lines([
+        "*serialized setup rerun: rerun=0 failed_to_verify=False "
+        "failed_fixtures=[[]'test_serialized_setup_rerun_reports.py::service'[]] longrepr=" + rerun_longrepr,
+        "*serialized failed: rerun=1 failed_to_verify=True "
+        "failed_fixtures=[[]'test_serialized_setup_rerun_reports.py::service'[]] longrepr=*Exception'",
+    ])
+
+
+def test_setup_metrics_file(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        ATTEMPTS = []
+
+        @pytest.fixture
+        def service():
+            {0}
+
+        @pytest.fixture
+        def flaky_service():
+            ATTEMPTS.append(1)
+            if len(ATTEMPTS) < 2:
+                raise Exception('Failure')
+
+        def test_example_1(service):
+            assert True
+
+        def test_example_2(flaky_service):
+            assert True
+
+        def test_example_3():
+            assert True
+        """.format(temporary_failure())
+    )
+    metrics = testdir.tmpdir.join('metrics.prom')
+    result = testdir.runpytest('--rerun-setup', '2', '--rerun-setup-metrics', str(metrics))
+    assert '1 failed to verify' in result.stdout.str()
+
+    lines = metrics.read().splitlines()
+    for line in ('pytest_setup_attempts_total 6',
+                 'pytest_setup_reruns_total 3',
+                 'pytest_setup_recoveries_total 1',
+                 'pytest_setup_failed_to_verify_total 1',
+                 'pytest_setup_fixture_failures_total{fixture="test_setup_metrics_file.py::service"} 3',
+                 'pytest_setup_fixture_failures_total{fixture="test_setup_metrics_file.py::flaky_service"} 1',
+                 '# TYPE pytest_setup_retry_seconds histogram',
+                 'pytest_setup_retry_seconds_bucket{fixture="test_setup_metrics_file.py::service",le="+Inf"} 2',
+                 'pytest_setup_retry_seconds_count{fixture="test_setup_metrics_file.py::flaky_service"} 1'):
+        assert line in lines
+    assert not [path for path in os.listdir(str(testdir.tmpdir)) if path.endswith('.tmp')]
+
+
+def test_ftv_last_runs_only_failed_to_verify_items(testdir):
+    testdir.makepyfile(
+        """
+        import os
+
+        import pytest
+
+        @pytest.fixture
+        def service():
+            if not os.path.exists('service_up'):
+                {0}
+
+        def test_example_1(service):
+            assert True
+
+        def test_example_2():
+            assert False
+
+        def test_example_3():
+            assert True
+        """.format(temporary_failure())
+    )
+    result = testdir.runpytest('--rerun-setup', '1')
+    assert '1 failed to verify' in result.stdout.str()
+
+    result = testdir.runpytest('--rerun-setup', '1', '--ftv-last', '-v')
+    result.stdout.fnmatch_lines(["run-last-failed-to-verify: rerunning 1 items that failed to verify, deselected 2"])
+    assert '1 failed to verify' in result.stdout.str()
+    assert '2 deselected' in result.stdout.str()
+    assert 'test_example_2' not in result.stdout.str()
+
+    testdir.tmpdir.join('service_up').write('')
+    result = testdir.runpytest('--rerun-setup', '1', '--ftv-last')
+    result.assert_outcomes(passed=1)
+
+    result = testdir.runpytest('--rerun-setup', '1', '--ftv-last')
+    result.stdout.fnmatch_lines(["run-last-failed-to-verify: no previously failed to verify tests, running all 3"])
+    result.assert_outcomes(passed=2, failed=1)
+
+
+def test_rerun_teardown_reinvokes_failed_finalizers(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        CALLS = []
+
+        @pytest.fixture
+        def database(request):
+            def drop():
+                CALLS.append('drop')
+                if len(CALLS) < 3:
+                    raise Exception('Failure')
+            request.addfinalizer(drop)
+
+        @pytest.fixture
+        def container(request):
+            def stop():
+                CALLS.append('stop')
+                raise Exception('Failure')
+            request.addfinalizer(stop)
+
+        @pytest.fixture
+        def service():
+            yield
+            CALLS.append('service')
+            raise Exception('Failure')
+
+        def test_example_1(database):
+            assert True
+
+        def test_example_2(container):
+            assert True
+
+        def test_example_3(service):
+            assert True
+
+        def test_calls():
+            assert CALLS == ['drop'] * 3 + ['stop'] * 3 + ['service']
+        """
+    )
+    result = testdir.runpytest('--rerun-teardown', '2', '-v')
+    result.stdout.fnmatch_lines([
+        "*test_example_1 PASSED*",
+        "*test_example_1 TEARDOWN RERUN*",
+        "*test_example_2 PASSED*",
+        "*test_example_2 ERROR*",
+    ])
+    assert '4 passed, 2 error' in result.stdout.str().replace('errors', 'error')
+    assert '1 teardown rerun' in result.stdout.str()
+
+
+def test_flaky_setup_teardown_reruns(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        from pytest_failed_to_verify import flaky_setup
+
+        CALLS = []
+
+        @flaky_setup(teardown_reruns=1)
+        @pytest.fixture
+        def database(request):
+            def drop():
+                CALLS.append('drop')
+                if len(CALLS) < 2:
+                    raise Exception('Failure')
+            request.addfinalizer(drop)
+
+        def test_example_1(database):
+            assert True
+        """
+    )
+    result = testdir.runpytest()
+    assert '1 passed, 1 teardown rerun' in result.stdout.str()
+    assert result.ret == 0
+
+
+def test_flaky_setup_spares_replace_a_failed_setup(testdir):
+    testdir.makeconftest(
+        """
+        import threading
+
+        import pytest
+        from pytest_failed_to_verify import flaky_setup
+
+        BUILT = []
+        TORN_DOWN = []
+
+        @flaky_setup(spares=1)
+        @pytest.fixture(scope='module')
+        def server():
+            name = threading.current_thread().name
+            BUILT.append(name)
+            if name == 'MainThread':
+                raise Exception('Failure')
+            yield name
+            TORN_DOWN.append(name)
+        """
+    )
+    testdir.makepyfile(
+        test_a="""
+        def test_example_1(server):
+            assert server == 'rerun-setup-spare-server'
+
+        def test_example_2(server):
+            assert server == 'rerun-setup-spare-server'
+        """,
+        test_b="""
+        from conftest import BUILT, TORN_DOWN
+
+        def test_spares_torn_down():
+            assert BUILT.count('MainThread') == 1
+            assert BUILT.count('rerun-setup-spare-server') == 2
+            assert TORN_DOWN == ['rerun-setup-spare-server'] * 2
+        """,
+    )
+    result = testdir.runpytest('--rerun-setup', '1')
+    assert '3 passed, 1 setup rerun' in result.stdout.str()
+
+
+def test_flaky_setup_spares_need_no_request():
+    from pytest_failed_to_verify import flaky_setup
+
+    def fixture(request):
+        pass
+
+    with pytest.raises(TypeError):
+        flaky_setup(spares=1)(fixture)